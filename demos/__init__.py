@@ -1,3 +1,23 @@
+"""
+Demo services that react to notifications from the Mirror API
+
+A demo service is a module listed in DEMOS. It can define handle_item
+for timeline notifications, handle_location for location notifications,
+CONTACTS and WELCOMES to set up when a user connects, and ROUTES for
+its own request handlers.
+
+HANDLES limits which notifications service/notify.py forwards to it:
+
+    collections  "timeline" and/or "locations", all collections with a
+                 callback if not given
+    actions      types of user actions, e.g. "SHARE" or "CUSTOM", timeline
+                 notifications with any of them are forwarded, all
+                 actions if not given
+    contacts     contact IDs, only timeline items sent to one of them are
+                 forwarded, items for any recipient if not given
+    budget       seconds a callback may run before it is abandoned,
+                 service/dispatch.py DEFAULT_BUDGET if not given
+"""
 
 # DEMOS = ["add_a_cat", "instaglass", "friend_finder", "check_in", "hodor"]
 DEMOS = ["hodor"]
@@ -29,9 +29,15 @@ from apiclient.errors import HttpError
 
 __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 
-__all__ = ["handle_item", "handle_location", "WELCOMES", "ROUTES"]
+__all__ = ["handle_item", "handle_location", "WELCOMES", "ROUTES", "HANDLES"]
 
 
+"""Notifications this service handles, see demos/__init__.py"""
+HANDLES = {
+    "collections": ["timeline", "locations"],
+    "actions": ["CUSTOM"]
+}
+
 """Welcome message cards that are sent when the user first connects to this service"""
 WELCOMES = [
     {
@@ -76,19 +82,38 @@ def handle_location(location, notification, service, test):
         return
 
     # 1. retrieve current bundle cards and delete non-cover cards
-    current_cards = service.timeline().list(bundleId=_BUNDLE_ID).execute()
-
     bundleCoverId = None
-    if "items" in current_cards:
-        for card in current_cards["items"]:
-            if "isBundleCover" in card and card["isBundleCover"] == True:
-                bundleCoverId = card["id"]
-                break
-               
-        for card in current_cards["items"]:
-            if bundleCoverId is None or card["id"] != bundleCoverId:
-                # delete old cards
-                service.timeline().delete(id=card["id"]).execute()
+    if test is not None:
+        # The emulator returns cover and card IDs of the bundle directly
+        current_bundles = service.timeline().bundles().list(bundleId=_BUNDLE_ID).execute()
+
+        oldIds = []
+        if "items" in current_bundles:
+            for bundle in current_bundles["items"]:
+                if "isBundleCover" in bundle["cover"] and bundle["cover"]["isBundleCover"] == True:
+                    bundleCoverId = bundle["cover"]["id"]
+                else:
+                    oldIds.append(bundle["cover"]["id"])
+
+                if "itemIds" in bundle:
+                    oldIds.extend(bundle["itemIds"])
+
+        if len(oldIds) > 0:
+            # delete old cards in one request
+            service.timeline().deleteMany(body={"ids": oldIds}).execute()
+    else:
+        current_cards = service.timeline().list(bundleId=_BUNDLE_ID).execute()
+
+        if "items" in current_cards:
+            for card in current_cards["items"]:
+                if "isBundleCover" in card and card["isBundleCover"] == True:
+                    bundleCoverId = card["id"]
+                    break
+
+            for card in current_cards["items"]:
+                if bundleCoverId is None or card["id"] != bundleCoverId:
+                    # delete old cards
+                    service.timeline().delete(id=card["id"]).execute()
                 
     # 2. create or update cover card
     map = "glass://map?w=640&h=360&"
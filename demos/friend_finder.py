@@ -17,9 +17,14 @@
 
 __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 
-__all__ = ["handle_location", "WELCOMES"]
+__all__ = ["handle_location", "WELCOMES", "HANDLES"]
 
 
+"""Notifications this service handles, see demos/__init__.py"""
+HANDLES = {
+    "collections": ["locations"]
+}
+
 """Welcome message cards that are sent when the user first connects to this service"""
 WELCOMES = [
     {
@@ -22,7 +22,7 @@ from utils import base_url
 import logging
 import random
 
-__all__ = ["handle_item", "CONTACTS", "WELCOMES"]
+__all__ = ["handle_item", "CONTACTS", "WELCOMES", "HANDLES"]
 
 """Contacts that need to registered when the user connects to this service"""
 CONTACTS = [
@@ -36,6 +36,13 @@ CONTACTS = [
     }
 ]
 
+"""Notifications this service handles, see demos/__init__.py"""
+HANDLES = {
+    "collections": ["timeline"],
+    "actions": ["LAUNCH", "REPLY"],
+    "contacts": ["hodor"]
+}
+
 """
 Welcome message cards that are sent when the user first connects
 to this service
@@ -85,29 +92,6 @@ RESPONSES = [
 def handle_item(item, notification, service, test):
     """Callback for Timeline updates."""
 
-    if "userActions" in notification:
-        for action in notification["userActions"]:
-            if ("type" in action and
-               (action["type"] == "LAUNCH" or action["type"] == "REPLY")):
-                break
-        else:
-            # No SHARE action
-            return
-    else:
-        # No SHARE action
-        return
-
-    if "recipients" in item:
-        for rec in item["recipients"]:
-            if rec["id"] == "hodor":
-                break
-        else:
-            # Item not meant for this service
-            return
-    else:
-        # Item not meant for this service
-        return
-
     hodor = random.randint(0, len(RESPONSES) - 1)
 
     response = {
@@ -25,7 +25,7 @@ import Image
 import ImageOps
 import cStringIO
 
-__all__ = ["handle_item", "CONTACTS", "WELCOMES"]
+__all__ = ["handle_item", "CONTACTS", "WELCOMES", "HANDLES"]
 
 """Contacts that need to registered when the user connects to this service"""
 CONTACTS = [
@@ -37,6 +37,14 @@ CONTACTS = [
     }
 ]
 
+"""Notifications this service handles, filtering images needs a larger budget"""
+HANDLES = {
+    "collections": ["timeline"],
+    "actions": ["SHARE"],
+    "contacts": ["instaglass_sepia"],
+    "budget": 60
+}
+
 """Welcome message cards that are sent when the user first connects to this service"""
 WELCOMES = [
     {
@@ -90,28 +98,6 @@ def _apply_sepia_filter(image):
 def handle_item(item, notification, service, test):
     """Callback for Timeline updates."""
 
-    if "userActions" in notification:
-        for action in notification["userActions"]:
-            if "type" in action and action["type"] == "SHARE":
-                break
-        else:
-            # No SHARE action
-            return
-    else:
-        # No SHARE action
-        return
-    
-    if "recipients" in item:
-        for rec in item["recipients"]:
-            if rec["id"] == "instaglass_sepia":
-                break
-        else:
-            # Item not meant for this service
-            return
-    else:
-        # Item not meant for this service
-        return
-
     imageId = None
     if "attachments" in item:
         for att in item["attachments"]:
@@ -126,6 +112,9 @@ def handle_item(item, notification, service, test):
     attachment_metadata = service.timeline().attachments().get(
         itemId=item["id"], attachmentId=imageId).execute()
     content_url = attachment_metadata.get("contentUrl")
+    if test is not None:
+        # Work on the rendition Glass displays instead of the full resolution image
+        content_url += "?size=display"
     resp, content = service._http.request(content_url)
 
     if resp.status != 200:
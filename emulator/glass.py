@@ -30,9 +30,9 @@ import json
 import logging
 import random
 import string
+import urllib
 
 from google.appengine.api import channel
-from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 
 
@@ -73,21 +73,14 @@ class GlassConnectHandler(utils.BaseHandler):
             self.response.out.write(utils.createError(401, "Invalid state parameter"))
             return
 
+        # Exchange the code and check the access token, verified locally if possible
         try:
-            oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-            oauth_flow.redirect_uri = 'postmessage'
-            credentials = oauth_flow.step2_exchange(code)
+            credentials, result = utils.exchange_code(code)
         except FlowExchangeError:
             self.response.status = 401
             self.response.out.write(utils.createError(401, "Failed to upgrade the authorization code."))
             return
 
-        # Check that the access token is valid.
-        access_token = credentials.access_token
-        url = ("https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s" % access_token)
-        h = httplib2.Http()
-        result = json.loads(h.request(url, 'GET')[1])
-
         # If there was an error in the access token info, abort.
         if result.get("error") is not None:
             self.response.status = 500
@@ -129,14 +122,15 @@ class AttachmentHandler(utils.BaseHandler):
         http = credentials.authorize(http)
         http.timeout = 60
 
-        resp, content = http.request("%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, timelineId, attachmentId))
-        if resp.status == 200:
-            self.response.content_type = resp["content-type"]
-            self.response.out.write(content)
-        else:
+        url = "%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, timelineId, attachmentId)
+        size = self.request.get("size")
+        if size:
+            url += "?size=" + urllib.quote(size)
+        status = utils.proxy_attachment(http, url, self.request, self.response)
+        if status not in (200, 206, 304):
             self.response.content_type = "application/json"
-            self.response.status = resp.status
-            self.response.out.write(utils.createError(resp.status, "Unable to retrieve attachment."))
+            self.response.status = status
+            self.response.out.write(utils.createError(status, "Unable to retrieve attachment."))
 
 
 GLASS_ROUTES = [
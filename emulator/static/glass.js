@@ -438,7 +438,7 @@
           if (att.contentType.indexOf("image/") === 0) {
             this.imageType = att.contentType;
             if (att.id) {
-              this.image = "/glass/attachment/" + this.id + "/" + att.id;
+              this.image = "/glass/attachment/" + this.id + "/" + att.id + "?size=display";
             } else {
               this.image = att.contentUrl;
             }
@@ -834,7 +834,7 @@
           if (att.contentType.indexOf("image/") === 0) {
             this.imageType = att.contentType;
             if (att.id) {
-              this.image = "/glass/attachment/" + this.id + "/" + att.id;
+              this.image = "/glass/attachment/" + this.id + "/" + att.id + "?size=display";
             } else {
               this.image = att.contentUrl;
             }
@@ -2035,6 +2035,11 @@
           if (data.id) {
             fetchCard(data.id);
           }
+          if (data.deleted) {
+            handleCards({"items": data.deleted.map(function (id) {
+              return {"id": id, "isDeleted": true};
+            })});
+          }
         }
       };
       socket.onerror = function (e) {
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed storage of attachments in cloud storage
+
+Attachment IDs are the SHA-256 hash of their content. Identical content
+uploaded several times is only kept once, an AttachmentBlob entity per
+hash points to the stored file and counts the cards referencing it.
+The file is only deleted when the last reference is released.
+
+Attachments stored before this scheme have their cloud storage file name
+as ID and no AttachmentBlob, they are still handled here.
+"""
+
+# Add the library location to the path
+import sys
+sys.path.insert(0, 'lib')
+
+import cloudstorage as gcs
+import datetime
+import hashlib
+import os
+import uuid
+
+from google.appengine.api import app_identity
+from google.appengine.ext import ndb
+
+from models import AttachmentBlob
+
+my_default_retry_params = gcs.RetryParams(initial_delay=0.2,
+                                          max_delay=5.0,
+                                          backoff_factor=2,
+                                          max_retry_period=15)
+
+gcs.set_default_retry_params(my_default_retry_params)
+
+bucket = "/" + os.environ.get("BUCKET_NAME", app_identity.get_default_gcs_bucket_name())
+
+_READ_SIZE = 256 * 1024
+
+
+@ndb.transactional
+def _add_reference(content_hash, object_name, content_type, size):
+    """Count a new reference to content_hash, returns False if the content was already stored"""
+
+    blob = ndb.Key(AttachmentBlob, content_hash).get()
+    if blob is None:
+        AttachmentBlob(id=content_hash, objectName=object_name,
+                       contentType=content_type, size=size, refCount=1).put()
+        return True
+
+    blob.refCount += 1
+    blob.put()
+    return False
+
+
+@ndb.transactional
+def _remove_reference(attachment_id):
+    """Remove a reference, returns the file and renditions to delete if it was the last one"""
+
+    blob = ndb.Key(AttachmentBlob, attachment_id).get()
+    if blob is None:
+        # Attachment from before content-addressed storage
+        return attachment_id, None
+
+    blob.refCount -= 1
+    if blob.refCount > 0:
+        blob.put()
+        return None, None
+
+    blob.key.delete()
+    return blob.objectName, blob.renditions
+
+
+def _delete_object(object_name):
+    try:
+        gcs.delete(bucket + "/" + object_name)
+    except gcs.NotFoundError:
+        pass
+
+
+def _register(object_name, content_hash, content_type, size):
+    """Reference the stored content by its hash, removing the new file if it is a duplicate"""
+
+    if not _add_reference(content_hash, object_name, content_type, size):
+        _delete_object(object_name)
+
+    return content_hash
+
+
+def store(chunks, content_type):
+    """Write media content to cloud storage chunk by chunk and return its attachment ID
+
+    The content has to be written before its hash is known, a duplicate
+    file is deleted again right away.
+    """
+
+    object_name = str(uuid.uuid4())
+    content_hash = hashlib.sha256()
+    size = 0
+
+    write_retry_params = gcs.RetryParams(backoff_factor=1.1)
+    gcs_file = gcs.open(bucket + "/" + object_name,
+                        'w',
+                        content_type=content_type,
+                        retry_params=write_retry_params)
+    try:
+        for chunk in chunks:
+            content_hash.update(chunk)
+            size += len(chunk)
+            gcs_file.write(chunk)
+        gcs_file.close()
+    except:
+        _delete_object(object_name)
+        raise
+
+    return _register(object_name, content_hash.hexdigest(), content_type, size)
+
+
+def adopt(object_name, content_type):
+    """Register a file that has already been written, e.g. by a resumable upload, and return its attachment ID"""
+
+    content_hash = hashlib.sha256()
+    size = 0
+
+    gcs_file = gcs.open(bucket + "/" + object_name, 'r', read_buffer_size=_READ_SIZE)
+    while True:
+        chunk = gcs_file.read(_READ_SIZE)
+        if not chunk:
+            break
+        content_hash.update(chunk)
+        size += len(chunk)
+    gcs_file.close()
+
+    return _register(object_name, content_hash.hexdigest(), content_type, size)
+
+
+def release(attachment_id):
+    """Remove a reference to an attachment, deleting the content with the last reference"""
+
+    object_name, renditions = _remove_reference(attachment_id)
+    if object_name is not None:
+        _delete_object(object_name)
+
+    if renditions:
+        for rendition_id in renditions.values():
+            release(rendition_id)
+
+
+def is_processed(attachment_id):
+    """Whether the processing queue is done with the content, always True for older attachments"""
+
+    blob = ndb.Key(AttachmentBlob, attachment_id).get()
+    return blob is None or blob.processed
+
+
+def unprocessed(attachment_ids):
+    """The subset of attachment_ids the processing queue still has to handle, with a single datastore call"""
+
+    blobs = ndb.get_multi([ndb.Key(AttachmentBlob, attachment_id) for attachment_id in attachment_ids])
+    return set(blob.key.id() for blob in blobs if blob is not None and not blob.processed)
+
+
+def get_renditions(attachment_id):
+    """Renditions of an attachment by size name, None if there are none"""
+
+    blob = ndb.Key(AttachmentBlob, attachment_id).get()
+    if blob is None:
+        return None
+
+    return blob.renditions
+
+
+@ndb.transactional
+def finish_processing(attachment_id, renditions, metadata):
+    """Store the results of processing an attachment
+
+    Returns False if the attachment has been deleted or processed by
+    another task in the meantime, the caller has to release the
+    renditions in that case.
+    """
+
+    blob = ndb.Key(AttachmentBlob, attachment_id).get()
+    if blob is None or blob.processed:
+        return False
+
+    blob.processed = True
+    blob.renditions = renditions
+    blob.metadata = metadata
+    blob.put()
+    return True
+
+
+def object_info(attachment_id):
+    """Cloud storage path and creation time of the content of an attachment
+
+    Raises:
+        cloudstorage.NotFoundError: if the content doesn't exist
+    """
+
+    blob = ndb.Key(AttachmentBlob, attachment_id).get()
+    if blob is not None:
+        return bucket + "/" + blob.objectName, blob.created
+
+    path = bucket + "/" + attachment_id
+    stat = gcs.stat(path)
+    return path, datetime.datetime.utcfromtimestamp(stat.st_ctime)
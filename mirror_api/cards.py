@@ -0,0 +1,62 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions to write timeline cards, shared by the API and the upload handlers"""
+
+import endpoints
+
+from models import MenuAction
+from models import TimelineItem
+
+# Card properties that requests are allowed to change, attachments are only added by uploads
+UPDATABLE_FIELDS = [field for field in TimelineItem._message_fields_schema
+                    if field not in ("id", "attachments", "created", "isDeleted", "updated")]
+
+
+def validate_menu_items(card):
+    """Check that all custom menu items of the card are complete"""
+
+    if card.menuItems is not None:
+        for menuItem in card.menuItems:
+            if menuItem.action == MenuAction.CUSTOM:
+                if menuItem.id is None:
+                    raise endpoints.BadRequestException("For custom actions id needs to be provided.")
+                if menuItem.values is None or len(menuItem.values) == 0:
+                    raise endpoints.BadRequestException("For custom actions at least one value needs to be provided.")
+                for value in menuItem.values:
+                    if value.displayName is None or value.iconUrl is None:
+                        raise endpoints.BadRequestException("Each value needs to contain displayName and iconUrl.")
+
+
+def copy_card_fields(source, target):
+    """Take over all values that have been set in source to target"""
+
+    for field in UPDATABLE_FIELDS:
+        value = getattr(source, field)
+        if value is not None and value != []:
+            setattr(target, field, value)
+
+
+def keep_stored_attachments(card, stored=None):
+    """Replace attachments sent in a request body with the ones of the stored card
+
+    Only uploads add a reference to the content of an attachment, IDs sent by
+    clients would be released with the card without ever being referenced.
+    """
+
+    if stored is not None and stored.attachments is not None:
+        card.attachments = list(stored.attachments)
+    else:
+        card.attachments = []
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helper functions to handle Idempotency-Key headers for insert requests.
+
+Clients that retry a request after a timeout send the same key again,
+and get the result of the first request instead of creating a duplicate.
+Results are kept in memcache for a limited time only.
+"""
+
+import httplib
+
+import endpoints
+
+from google.appengine.api import memcache
+
+HEADER = "Idempotency-Key"
+
+# Marker stored while the first request with a key is still being processed
+PENDING = "__pending__"
+
+_NAMESPACE = "idempotency"
+
+# How long results are returned for repeated requests
+_RESULT_TTL = 24 * 60 * 60
+
+# How long a key stays claimed if the first request never finishes
+_PENDING_TTL = 60
+
+
+class RequestInProgressException(endpoints.ServiceException):
+    """A request with the same Idempotency-Key is still being processed"""
+    http_status = httplib.CONFLICT
+
+
+def _cache_key(scope, key):
+    return "%s:%s" % (scope, key)
+
+
+def begin(scope, key):
+    """Claim key for a new request in scope (usually the current user).
+
+    Returns None if the request should be processed, PENDING if a request
+    with the same key is still being processed, or the result stored by
+    finish for an earlier request.
+    """
+
+    cache_key = _cache_key(scope, key)
+    if memcache.add(cache_key, PENDING, time=_PENDING_TTL, namespace=_NAMESPACE):
+        return None
+
+    return memcache.get(cache_key, namespace=_NAMESPACE)
+
+
+def finish(scope, key, result):
+    """Store the result of a successful request to be returned for retries"""
+
+    memcache.set(_cache_key(scope, key), result, time=_RESULT_TTL, namespace=_NAMESPACE)
+
+
+def abort(scope, key):
+    """Release the key after a failed request so that it can be retried"""
+
+    memcache.delete(_cache_key(scope, key), namespace=_NAMESPACE)
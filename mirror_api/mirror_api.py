@@ -20,21 +20,27 @@
 import sys
 sys.path.insert(0, 'lib')
 
-import cloudstorage as gcs
 import endpoints
+import functools
 import json
 import os
-import logging
 import sys
-import urllib2
 
 from google.appengine.api import app_identity
 from google.appengine.api import channel
+from google.appengine.api import datastore_errors
+from google.appengine.api import search
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 from protorpc import remote
 
+import attachments
+import cards
+import idempotency
+import notifications
+import search_index
+import tokens
 from models import TimelineItem
-from models import MenuAction
 from models import UserAction
 from models import Operation
 from models import Contact
@@ -46,21 +52,20 @@ from models import AttachmentListRequest
 from models import AttachmentRequest
 from models import AttachmentResponse
 from models import AttachmentList
+from models import BundleListRequest
+from models import Bundle
+from models import BundleList
+from models import TimelineSearchRequest
+from models import DeleteManyRequest
+from models import DeleteManyResponse
+from models import SourceItem
+from models import source_item_id
 
 
 _ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 _SECRETS_PATH = os.path.join(_ROOT_DIR, "client_secrets.json")
 _CLIENT_IDs = [endpoints.API_EXPLORER_CLIENT_ID]
 
-my_default_retry_params = gcs.RetryParams(initial_delay=0.2,
-                                          max_delay=5.0,
-                                          backoff_factor=2,
-                                          max_retry_period=15)
-
-gcs.set_default_retry_params(my_default_retry_params)
-
-bucket = "/" + os.environ.get("BUCKET_NAME", app_identity.get_default_gcs_bucket_name())
-
 with open(_SECRETS_PATH, "r") as fh:
     _secrets = json.load(fh)["web"]
     _CLIENT_IDs.append(_secrets["client_id"])
@@ -70,6 +75,114 @@ with open(_SECRETS_PATH, "r") as fh:
 API_DESCRIPTION = ("Mirror API implemented using Google Cloud "
                    "Endpoints for testing")
 
+# Most cards timeline.deleteMany removes in one request
+_MAX_DELETE_IDS = 1000
+
+def _get_current_user():
+    """User of the current request, resolved once per request by tokens.get_request_user"""
+
+    return tokens.get_request_user()
+
+
+def _user_required(method):
+    """Reject requests without a valid token
+
+    Used instead of user_required=True, which always verifies the token with
+    Cloud Endpoints, so all methods share the token cache. The user is
+    resolved once here, later calls of _get_current_user reuse it.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, request):
+        if _get_current_user() is None:
+            raise endpoints.UnauthorizedException("Invalid token.")
+        return method(self, request)
+
+    return wrapper
+
+
+def _tombstone_card(card):
+    """Delete the attachments of a card and reset all properties except the ID.
+
+    The card still has to be put afterwards.
+    """
+
+    # Release attachments, content shared with other cards is kept
+    if card.attachments is not None:
+        for att in card.attachments:
+            attachments.release(att.id)
+
+    card.attachments = []
+    card.bundleId = None
+    card.canonicalUrl = None
+    card.created = None
+    card.creator = None
+    card.displayTime = None
+    card.html = None
+    card.inReplyTo = None
+    card.isBundleCover = None
+    card.isPinned = None
+    card.menuItems = []
+    card.notification = None
+    card.recipients = []
+    card.sourceItemId = None
+    card.speakableType = None
+    card.speakableText = None
+    card.text = None
+    card.title = None
+    card.updated = None
+    card.isDeleted = True
+
+
+@ndb.transactional
+def _put_updated_card(card):
+    """Store an updated card with the attachments of the stored card, False if it has been deleted
+
+    The stored card is read in the transaction, so attachments whose
+    processing finished in the meantime keep isProcessingContent cleared.
+    """
+
+    stored = card.key.get(use_cache=False)
+    if stored is None or stored.isDeleted:
+        return False
+
+    cards.keep_stored_attachments(card, stored)
+    card.put()
+    return True
+
+
+@ndb.transactional(xg=True)
+def _upsert_card(card, candidate):
+    """Update the card of the user for card.sourceItemId with all values set in card,
+    or insert card if there is none.
+
+    The SourceItem mapping is read and written in the transaction, so concurrent
+    upserts of a new sourceItemId can't both insert a card. candidate is a card
+    found by query, for cards inserted with a sourceItemId before they were upserted.
+    The card is in its own entity group, hence the cross-group transaction.
+    """
+
+    mapping_key = ndb.Key(SourceItem, source_item_id(card.user, card.sourceItemId))
+    mapping = mapping_key.get()
+    if mapping is not None:
+        candidate = ndb.Key(TimelineItem, mapping.itemId)
+
+    existing = candidate.get() if candidate is not None else None
+
+    if existing is None or existing.isDeleted or existing.sourceItemId != card.sourceItemId:
+        card.key = ndb.Key(TimelineItem, TimelineItem.allocate_ids(1)[0])
+        card.isDeleted = False
+        ndb.put_multi([card, SourceItem(key=mapping_key, itemId=card.key.integer_id())])
+        return card
+
+    cards.copy_card_fields(card, existing)
+
+    if mapping is None:
+        ndb.put_multi([existing, SourceItem(key=mapping_key, itemId=existing.key.integer_id())])
+    else:
+        existing.put()
+    return existing
+
 
 @endpoints.api(name="mirror", version="v1",
                description=API_DESCRIPTION,
@@ -79,56 +192,207 @@ class MirrorApi(remote.Service):
     """Class which defines the Mirror API v1."""
 
     @TimelineItem.query_method(query_fields=("maxResults", "pageToken", "bundleId", "includeDeleted", "pinnedOnly", "sourceItemId"),
-                               user_required=True,
                                path="timeline", name="timeline.list")
+    @_user_required
     def timeline_list(self, query):
         """List timeline cards for the current user."""
 
         query = query.order(-TimelineItem.updated)
-        query = query.filter(TimelineItem.user == endpoints.get_current_user())
+        query = query.filter(TimelineItem.user == _get_current_user())
         return query
 
+    @endpoints.method(BundleListRequest, BundleList,
+                      path="bundles", http_method="GET",
+                      name="timeline.bundles.list")
+    def bundles_list(self, request):
+        """List bundles for the current user.
+
+        Each bundle is returned once, with its cover card, the IDs of the
+        other cards in the bundle and their count, so clients don't have to
+        retrieve all cards of a bundle to display it.
+
+        Pages hold up to maxResults bundles in the order of their bundleId,
+        sorted by their latest update within the page.
+        """
+
+        current_user = _get_current_user()
+        if current_user is None:
+            raise endpoints.UnauthorizedException("Authentication required.")
+
+        if request.maxResults < 1:
+            raise endpoints.BadRequestException("maxResults must be at least 1.")
+
+        start_cursor = None
+        if request.pageToken is not None:
+            try:
+                start_cursor = Cursor(urlsafe=request.pageToken)
+            except (datastore_errors.BadValueError, TypeError):
+                raise endpoints.BadRequestException("Invalid pageToken.")
+
+        # Deleted cards have their bundleId removed, so they never show up here
+        query = TimelineItem.query().filter(TimelineItem.user == current_user)
+        if request.bundleId is not None:
+            query = query.filter(TimelineItem.bundleId == request.bundleId)
+            projection = [TimelineItem.isBundleCover]
+        else:
+            query = query.filter(TimelineItem.bundleId > "")
+            projection = [TimelineItem.bundleId, TimelineItem.isBundleCover]
+        query = query.order(TimelineItem.bundleId, -TimelineItem.updated)
+
+        bundle_ids = []
+        covers = {}
+        children = {}
+        next_page_token = None
+        items = query.iter(projection=projection, start_cursor=start_cursor, produce_cursors=True)
+        for item in items:
+            bundle_id = request.bundleId or item.bundleId
+            if bundle_id not in children:
+                if len(bundle_ids) == request.maxResults:
+                    # The cards of a bundle are next to each other, the next page starts with this one
+                    next_page_token = items.cursor_before().urlsafe()
+                    break
+                bundle_ids.append(bundle_id)
+                children[bundle_id] = []
+            if item.isBundleCover and bundle_id not in covers:
+                covers[bundle_id] = item.key
+            else:
+                children[bundle_id].append(item.key)
+
+        # Bundles without an explicit cover use their latest card as cover
+        for bundle_id in bundle_ids:
+            if bundle_id not in covers:
+                covers[bundle_id] = children[bundle_id].pop(0)
+
+        cover_cards = ndb.get_multi([covers[bundle_id] for bundle_id in bundle_ids])
+        cover_cards = [(bundle_id, cover) for bundle_id, cover in zip(bundle_ids, cover_cards) if cover is not None]
+        cover_cards.sort(key=lambda bundle: bundle[1].updated, reverse=True)
+
+        bundles = []
+        for bundle_id, cover in cover_cards:
+            item_ids = [key.integer_id() for key in children[bundle_id]]
+            bundles.append(Bundle(bundleId=bundle_id,
+                                  cover=cover.ToMessage(),
+                                  itemIds=item_ids,
+                                  count=len(item_ids)))
+
+        return BundleList(items=bundles, nextPageToken=next_page_token)
+
+    @endpoints.method(TimelineSearchRequest, TimelineItem.ProtoCollection(),
+                      path="search", http_method="GET",
+                      name="timeline.search")
+    def timeline_search(self, request):
+        """Full-text search in text, title, speakableText and html of the current user's cards."""
+
+        current_user = _get_current_user()
+        if current_user is None:
+            raise endpoints.UnauthorizedException("Authentication required.")
+
+        if request.maxResults < 1 or request.maxResults > search_index.MAX_RESULTS:
+            raise endpoints.BadRequestException("maxResults must be between 1 and %s." % search_index.MAX_RESULTS)
+
+        try:
+            ids = search_index.search_cards(current_user, request.q, request.maxResults)
+        except search.QueryError:
+            raise endpoints.BadRequestException("Invalid search query.")
+
+        items = ndb.get_multi([ndb.Key(TimelineItem, id) for id in ids])
+        items = [card for card in items if card is not None and card.user == current_user and not card.isDeleted]
+
+        return TimelineItem.ToMessageCollection(items)
+
     @TimelineItem.method(request_fields=("id",),
-                         user_required=True,
                          path="timeline/{id}", http_method="GET",
                          name="timeline.get")
+    @_user_required
     def timeline_get(self, card):
         """Get card with ID for the current user"""
 
-        if not card.from_datastore or card.user != endpoints.get_current_user():
+        if not card.from_datastore or card.user != _get_current_user():
             raise endpoints.NotFoundException("Card not found.")
 
         return card
 
-    @TimelineItem.method(user_required=True, http_method="POST",
+    @TimelineItem.method(http_method="POST",
                          path="timeline", name="timeline.insert")
+    @_user_required
     def timeline_insert(self, card):
         """Insert a card for the current user."""
 
         if card.id is not None:
             raise endpoints.BadRequestException("ID is not allowed in request body.")
 
-        if card.menuItems is not None:
-            for menuItem in card.menuItems:
-                if menuItem.action == MenuAction.CUSTOM:
-                    if menuItem.id is None:
-                        raise endpoints.BadRequestException("For custom actions id needs to be provided.")
-                    if menuItem.values is None or len(menuItem.values) == 0:
-                        raise endpoints.BadRequestException("For custom actions at least one value needs to be provided.")
-                    for value in menuItem.values:
-                        if value.displayName is None or value.iconUrl is None:
-                            raise endpoints.BadRequestException("Each value needs to contain displayName and iconUrl.")
-
+        cards.validate_menu_items(card)
+        cards.keep_stored_attachments(card)
+
+        # Retried requests get the card created by the first request
+        scope = _get_current_user().email()
+        idempotency_key = self.request_state.headers.get(idempotency.HEADER)
+        if idempotency_key is not None:
+            result = idempotency.begin(scope, idempotency_key)
+            if result == idempotency.PENDING:
+                raise idempotency.RequestInProgressException("A request with the same Idempotency-Key is still being processed.")
+            if result is not None:
+                original = ndb.Key(TimelineItem, result).get()
+                if original is not None:
+                    return original
+
+        card.user = _get_current_user()
         card.isDeleted = False
 
-        card.put()
+        try:
+            card.put()
+        except:
+            if idempotency_key is not None:
+                idempotency.abort(scope, idempotency_key)
+            raise
+
+        if idempotency_key is not None:
+            idempotency.finish(scope, idempotency_key, card.key.integer_id())
 
         channel.send_message(card.user.email(), json.dumps({"id": card.id}))
 
         return card
 
-    @TimelineItem.method(user_required=True, http_method="POST",
+    @TimelineItem.method(http_method="POST",
+                         path="timeline/upsert", name="timeline.upsert")
+    @_user_required
+    def timeline_upsert(self, card):
+        """Insert or update the card with the given sourceItemId for the current user.
+
+        Allows services that mirror external objects to keep their cards in sync
+        without having to list or delete existing cards first.
+        """
+
+        if card.id is not None:
+            raise endpoints.BadRequestException("ID is not allowed in request body.")
+
+        if card.sourceItemId is None:
+            raise endpoints.BadRequestException("sourceItemId needs to be provided.")
+
+        cards.validate_menu_items(card)
+        cards.keep_stored_attachments(card)
+
+        card.user = _get_current_user()
+
+        # Cards that have never been upserted have no SourceItem yet, the transaction
+        # only takes the candidate if it still doesn't find one.
+        # Deleted cards have their sourceItemId removed, so they never match here
+        candidate = None
+        if ndb.Key(SourceItem, source_item_id(card.user, card.sourceItemId)).get() is None:
+            query = TimelineItem.query().filter(TimelineItem.user == card.user)
+            query = query.filter(TimelineItem.sourceItemId == card.sourceItemId)
+            query = query.order(-TimelineItem.updated)
+            candidate = query.get(keys_only=True)
+
+        card = _upsert_card(card, candidate)
+
+        channel.send_message(card.user.email(), json.dumps({"id": card.id}))
+
+        return card
+
+    @TimelineItem.method(http_method="POST",
                          path="internal/timeline", name="internal.timeline.insert")
+    @_user_required
     def timeline_internal_insert(self, card):
         """Insert a card for the current user. Internal method for the Emulator to work.
         Not part of the actual Mirror API and shouldn't be used.
@@ -137,56 +401,51 @@ class MirrorApi(remote.Service):
         if card.id is not None:
             raise endpoints.BadRequestException("ID is not allowed in request body.")
 
-        if card.menuItems is not None:
-            for menuItem in card.menuItems:
-                if menuItem.action == MenuAction.CUSTOM:
-                    if menuItem.id is None:
-                        raise endpoints.BadRequestException("For custom actions id needs to be provided.")
-                    if menuItem.values is None or len(menuItem.values) == 0:
-                        raise endpoints.BadRequestException("For custom actions at least one value needs to be provided.")
-                    for value in menuItem.values:
-                        if value.displayName is None or value.iconUrl is None:
-                            raise endpoints.BadRequestException("Each value needs to contain displayName and iconUrl.")
+        cards.validate_menu_items(card)
+        cards.keep_stored_attachments(card)
 
+        card.user = _get_current_user()
         card.isDeleted = False
 
         card.put()
 
         return card
 
-    @TimelineItem.method(user_required=True,
-                         path="timeline/{id}", http_method="PUT",
+    @TimelineItem.method(path="timeline/{id}", http_method="PUT",
                          name="timeline.update")
+    @_user_required
     def timeline_update(self, card):
         """Update card with ID for the current user"""
 
-        if not card.from_datastore or card.user != endpoints.get_current_user():
+        if not card.from_datastore or card.user != _get_current_user():
             raise endpoints.NotFoundException("Card not found.")
 
         if card.isDeleted:
             raise endpoints.NotFoundException("Card has been deleted")
 
-        card.put()
+        if not _put_updated_card(card):
+            raise endpoints.NotFoundException("Card has been deleted")
 
         channel.send_message(card.user.email(), json.dumps({"id": card.id}))
 
         return card
 
-    @TimelineItem.method(user_required=True,
-                         path="internal/timeline/{id}", http_method="PUT",
+    @TimelineItem.method(path="internal/timeline/{id}", http_method="PUT",
                          name="internal.timeline.update")
+    @_user_required
     def timeline_internal_update(self, card):
         """Update card with ID for the current user.  Internal method for the Emulator to work.
         Not part of the actual Mirror API and shouldn't be used.
         """
 
-        if not card.from_datastore or card.user != endpoints.get_current_user():
+        if not card.from_datastore or card.user != _get_current_user():
             raise endpoints.NotFoundException("Card not found.")
 
         if card.isDeleted:
             raise endpoints.NotFoundException("Card has been deleted")
 
-        card.put()
+        if not _put_updated_card(card):
+            raise endpoints.NotFoundException("Card has been deleted")
 
         channel.send_message(card.user.email(), json.dumps({"id": card.id}))
 
@@ -194,49 +453,22 @@ class MirrorApi(remote.Service):
 
     @TimelineItem.method(request_fields=("id",),
                          response_fields=("id",),
-                         user_required=True,
                          path="timeline/{id}", http_method="DELETE",
                          name="timeline.delete")
+    @_user_required
     def timeline_delete(self, card):
         """Remove an existing card for the current user.
 
         This will set all properties except the ID to None and set isDeleted to true
         """
 
-        if not card.from_datastore or card.user != endpoints.get_current_user():
+        if not card.from_datastore or card.user != _get_current_user():
             raise endpoints.NotFoundException("Contact not found.")
 
         if card.isDeleted:
             raise endpoints.NotFoundException("Card has been deleted")
 
-        # Delete attachments
-        if card.attachments is not None:
-            for att in card.attachments:
-                try:
-                    gcs.delete(bucket + "/" + att.id)
-                except gcs.NotFoundError:
-                    pass
-
-        card.attachments = []
-        card.bundleId = None
-        card.canonicalUrl = None
-        card.created = None
-        card.creator = None
-        card.displayTime = None
-        card.html = None
-        card.inReplyTo = None
-        card.isBundleCover = None
-        card.isPinned = None
-        card.menuItems = []
-        card.notification = None
-        card.recipients = []
-        card.sourceItemId = None
-        card.speakableType = None
-        card.speakableText = None
-        card.text = None
-        card.title = None
-        card.updated = None
-        card.isDeleted = True
+        _tombstone_card(card)
         card.put()
 
         # Notify Glass emulator
@@ -246,47 +478,92 @@ class MirrorApi(remote.Service):
         data = {}
         data["collection"] = "timeline"
         data["itemId"] = card.id
-        operation = Operation.DELETE
-        data["operation"] = operation.name
+        notifications.notify_subscriptions(_get_current_user(), Operation.DELETE, data)
 
-        header = {"Content-type": "application/json"}
+        return card
 
-        query = Subscription.query().filter(Subscription.user == endpoints.get_current_user())
-        query = query.filter(Subscription.collection == "timeline")
-        query = query.filter(Subscription.operation == operation)
-        for subscription in query.fetch():
-            data["userToken"] = subscription.userToken
-            data["verifyToken"] = subscription.verifyToken
+    @endpoints.method(DeleteManyRequest, DeleteManyResponse,
+                      path="timeline/delete", http_method="POST",
+                      name="timeline.deleteMany")
+    def timeline_delete_many(self, request):
+        """Remove all cards in a bundle and/or with the given IDs for the current user.
 
-            req = urllib2.Request(subscription.callbackUrl, json.dumps(data), header)
-            try:
-                urllib2.urlopen(req)
-            except:
-                logging.error(sys.exc_info()[0])
+        All cards are deleted in one batch and subscriptions get one DELETE
+        notification with all itemIds instead of one per card.
+        """
 
-        return card
+        current_user = _get_current_user()
+        if current_user is None:
+            raise endpoints.UnauthorizedException("Authentication required.")
+
+        if request.bundleId is None and len(request.ids) == 0:
+            raise endpoints.BadRequestException("bundleId or ids need to be provided.")
+
+        if len(request.ids) > _MAX_DELETE_IDS:
+            raise endpoints.BadRequestException("At most %s cards can be deleted at once." % _MAX_DELETE_IDS)
+
+        keys = [ndb.Key(TimelineItem, id) for id in request.ids]
+
+        if request.bundleId is not None:
+            query = TimelineItem.query().filter(TimelineItem.user == current_user)
+            query = query.filter(TimelineItem.bundleId == request.bundleId)
+            keys.extend(query.fetch(_MAX_DELETE_IDS + 1, keys_only=True))
+
+        # Without duplicates, in the order of the request
+        seen = set()
+        unique_keys = []
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                unique_keys.append(key)
+
+        if len(unique_keys) > _MAX_DELETE_IDS:
+            raise endpoints.BadRequestException("At most %s cards can be deleted at once." % _MAX_DELETE_IDS)
+
+        items = ndb.get_multi(unique_keys)
+        items = [card for card in items if card is not None and card.user == current_user and not card.isDeleted]
+
+        if len(items) == 0:
+            return DeleteManyResponse(ids=[])
+
+        for card in items:
+            _tombstone_card(card)
+        ndb.put_multi(items)
 
-    @Contact.query_method(user_required=True,
-                          path="contacts", name="contacts.list")
+        ids = [card.key.integer_id() for card in items]
+
+        # Notify Glass emulator
+        channel.send_message(current_user.email(), json.dumps({"deleted": [str(id) for id in ids]}))
+
+        # Notify timeline DELETE subscriptions
+        data = {}
+        data["collection"] = "timeline"
+        data["itemIds"] = ids
+        notifications.notify_subscriptions(current_user, Operation.DELETE, data)
+
+        return DeleteManyResponse(ids=ids)
+
+    @Contact.query_method(path="contacts", name="contacts.list")
+    @_user_required
     def contacts_list(self, query):
         """List all Contacts registered for the current user."""
 
-        return query.filter(Contact.user == endpoints.get_current_user())
+        return query.filter(Contact.user == _get_current_user())
 
     @Contact.method(request_fields=("id",),
-                    user_required=True,
                     path="contacts/{id}", http_method="GET",
                     name="contacts.get")
+    @_user_required
     def contacts_get(self, contact):
         """Get contact with ID for the current user"""
 
-        if not contact.from_datastore or contact.user != endpoints.get_current_user():
+        if not contact.from_datastore or contact.user != _get_current_user():
             raise endpoints.NotFoundException("Contact not found.")
 
         return contact
 
-    @Contact.method(user_required=True,
-                    path="contacts", name="contacts.insert")
+    @Contact.method(path="contacts", name="contacts.insert")
+    @_user_required
     def contacts_insert(self, contact):
         """Insert a new Contact for the current user."""
 
@@ -300,45 +577,47 @@ class MirrorApi(remote.Service):
         if contact.from_datastore:
             return contact
 
+        contact.user = _get_current_user()
         contact.put()
         return contact
 
     @Contact.method(request_fields=("id",),
                     response_fields=("id",),
-                    user_required=True,
                     path="contacts/{id}", http_method="DELETE",
                     name="contacts.delete")
+    @_user_required
     def contacts_delete(self, contact):
         """Remove an existing Contact for the current user."""
 
-        if not contact.from_datastore or contact.user != endpoints.get_current_user():
+        if not contact.from_datastore or contact.user != _get_current_user():
             raise endpoints.NotFoundException("Contact not found.")
 
         contact.key.delete()
 
         return contact
 
-    @Contact.method(user_required=True,
-                    path="contacts/{id}", http_method="PUT",
+    @Contact.method(path="contacts/{id}", http_method="PUT",
                     name="contacts.update")
+    @_user_required
     def contacts_update(self, contact):
         """Update Contact with ID for the current user"""
 
-        if not contact.from_datastore or contact.user != endpoints.get_current_user():
+        if not contact.from_datastore or contact.user != _get_current_user():
             raise endpoints.NotFoundException("Card not found.")
 
         contact.put()
         return contact
 
-    @Subscription.query_method(user_required=True,
-                               path="subscriptions", name="subscriptions.list")
+    @Subscription.query_method(path="subscriptions", name="subscriptions.list")
+    @_user_required
     def subscriptions_list(self, query):
         """List all Subscriptions registered for the current user."""
 
-        return query.filter(Contact.user == endpoints.get_current_user())
+        return query.filter(Contact.user == _get_current_user())
 
-    @Subscription.method(user_required=True, http_method="POST",
+    @Subscription.method(http_method="POST",
                          path="subscriptions", name="subscriptions.insert")
+    @_user_required
     def subscription_insert(self, subscription):
         """Insert a new subscription for the current user."""
 
@@ -348,36 +627,37 @@ class MirrorApi(remote.Service):
         if subscription.operation is None or len(subscription.operation) == 0:
             subscription.operation = [Operation.UPDATE, Operation.INSERT, Operation.DELETE]
 
+        subscription.user = _get_current_user()
         subscription.put()
         return subscription
 
     @Subscription.method(request_fields=("id",),
                          response_fields=("id",),
-                         user_required=True,
                          path="subscriptions/{id}", http_method="DELETE",
                          name="subscriptions.delete")
+    @_user_required
     def subscription_delete(self, subscription):
         """Remove an existing subscription for the current user."""
 
-        if not subscription.from_datastore or subscription.user != endpoints.get_current_user():
+        if not subscription.from_datastore or subscription.user != _get_current_user():
             raise endpoints.NotFoundException("Card not found.")
 
         subscription.key.delete()
 
         return subscription
 
-    @Location.query_method(user_required=True,
-                           path="locations", name="locations.list")
+    @Location.query_method(path="locations", name="locations.list")
+    @_user_required
     def locations_list(self, query):
         """List locations for the current user."""
 
         query = query.order(-Location.timestamp)
-        return query.filter(TimelineItem.user == endpoints.get_current_user())
+        return query.filter(TimelineItem.user == _get_current_user())
 
     @Location.method(request_fields=("id",),
-                     user_required=True,
                      path="locations/{id}", http_method="GET",
                      name="locations.get")
+    @_user_required
     def locations_get(self, location):
         """Retrieve a single location for the current user.
 
@@ -385,13 +665,14 @@ class MirrorApi(remote.Service):
         latest known position of the user.
         """
 
-        if not location.from_datastore or location.user != endpoints.get_current_user():
+        if not location.from_datastore or location.user != _get_current_user():
             raise endpoints.NotFoundException("Location not found.")
 
         return location
 
-    @Location.method(user_required=True, http_method="POST",
+    @Location.method(http_method="POST",
                      path="internal/locations", name="internal.locations.insert")
+    @_user_required
     def locations_insert(self, location):
         """Insert a new location for the current user.
 
@@ -401,6 +682,7 @@ class MirrorApi(remote.Service):
         if location.id is not None:
             raise endpoints.BadRequestException("ID is not allowed in request body.")
 
+        location.user = _get_current_user()
         location.put()
 
         # Notify location subscriptions
@@ -408,23 +690,7 @@ class MirrorApi(remote.Service):
         data = {}
         data["collection"] = "locations"
         data["itemId"] = "latest"
-        operation = Operation.UPDATE
-        data["operation"] = operation.name
-
-        header = {"Content-type": "application/json"}
-
-        query = Subscription.query().filter(Subscription.user == endpoints.get_current_user())
-        query = query.filter(Subscription.collection == "locations")
-        query = query.filter(Subscription.operation == operation)
-        for subscription in query.fetch():
-            data["userToken"] = subscription.userToken
-            data["verifyToken"] = subscription.verifyToken
-
-            req = urllib2.Request(subscription.callbackUrl, json.dumps(data), header)
-            try:
-                urllib2.urlopen(req)
-            except:
-                logging.error(sys.exc_info()[0])
+        notifications.notify_subscriptions(_get_current_user(), Operation.UPDATE, data)
 
         return location
 
@@ -434,7 +700,7 @@ class MirrorApi(remote.Service):
     def attachments_list(self, request):
         """Retrieve attachments for a timeline card"""
 
-        current_user = endpoints.get_current_user()
+        current_user = _get_current_user()
         if current_user is None:
             raise endpoints.UnauthorizedException("Authentication required.")
 
@@ -443,16 +709,16 @@ class MirrorApi(remote.Service):
         if card is None or card.user != current_user:
             raise endpoints.NotFoundException("Card not found.")
 
-        attachments = []
+        items = []
 
         if card.attachments is not None:
             for att in card.attachments:
-                attachments.append(AttachmentResponse(id=att.id,
-                                                      contentType=att.contentType,
-                                                      contentUrl=att.contentUrl,
-                                                      isProcessingContent=att.isProcessingContent))
+                items.append(AttachmentResponse(id=att.id,
+                                                contentType=att.contentType,
+                                                contentUrl=att.contentUrl,
+                                                isProcessingContent=att.isProcessingContent))
 
-        return AttachmentList(items=attachments)
+        return AttachmentList(items=items)
 
     @endpoints.method(AttachmentRequest, AttachmentResponse,
                       path="timeline/{itemId}/attachments/{attachmentId}", http_method="GET",
@@ -460,7 +726,7 @@ class MirrorApi(remote.Service):
     def attachments_get(self, request):
         """Retrieve metainfo for a single attachments for a timeline card"""
 
-        current_user = endpoints.get_current_user()
+        current_user = _get_current_user()
         if current_user is None:
             raise endpoints.UnauthorizedException("Authentication required.")
 
@@ -485,7 +751,7 @@ class MirrorApi(remote.Service):
     def attachments_delete(self, request):
         """Remove single attachment for a timeline card"""
 
-        current_user = endpoints.get_current_user()
+        current_user = _get_current_user()
         if current_user is None:
             raise endpoints.UnauthorizedException("Authentication required.")
 
@@ -497,11 +763,8 @@ class MirrorApi(remote.Service):
         if card.attachments is not None:
             for att in card.attachments:
                 if att.id == request.attachmentId:
-                    # Delete attachment from blobstore
-                    try:
-                        gcs.delete(bucket + "/" + att.id)
-                    except gcs.NotFoundError:
-                        pass
+                    # Release attachment content, deleted with the last reference
+                    attachments.release(att.id)
 
                     # Remove attachment from timeline card
                     card.attachments.remove(att)
@@ -523,7 +786,7 @@ class MirrorApi(remote.Service):
         Returns just a simple success message
         """
 
-        current_user = endpoints.get_current_user()
+        current_user = _get_current_user()
         if current_user is None:
             raise endpoints.UnauthorizedException("Authentication required.")
 
@@ -575,20 +838,7 @@ class MirrorApi(remote.Service):
             data["userActions"] = [{"type": UserAction.LAUNCH.name}]
 
         if data is not None and operation is not None:
-            header = {"Content-type": "application/json"}
-
-            query = Subscription.query().filter(Subscription.user == current_user)
-            query = query.filter(Subscription.collection == "timeline")
-            query = query.filter(Subscription.operation == operation)
-            for subscription in query.fetch():
-                data["userToken"] = subscription.userToken
-                data["verifyToken"] = subscription.verifyToken
-
-                req = urllib2.Request(subscription.callbackUrl, json.dumps(data), header)
-                try:
-                    urllib2.urlopen(req)
-                except:
-                    logging.error(sys.exc_info()[0])
+            notifications.notify_subscriptions(current_user, operation, data)
 
         # Report back to Glass emulator
         channel.send_message(current_user.email(), json.dumps({"id": action.itemId}))
@@ -31,6 +31,18 @@ from endpoints_proto_datastore.ndb import EndpointsModel
 from endpoints_proto_datastore.ndb import EndpointsUserProperty
 from endpoints_proto_datastore.ndb import EndpointsAliasProperty
 
+import search_index
+import tokens
+
+
+def _request_user():
+    """User of the current request through the token cache, instead of the one of EndpointsUserProperty"""
+
+    user = tokens.get_request_user()
+    if user is None:
+        raise endpoints.UnauthorizedException("Invalid token.")
+    return user
+
 
 class MenuAction(messages.Enum):
     REPLY = 1
@@ -93,6 +105,8 @@ class Location(EndpointsModel):
         if not isinstance(value, basestring):
             raise TypeError("ID must be a string.")
 
+        self.user = _request_user()
+
         if value == "latest":
             self._latest = True
             loc_query = Location.query().order(-Location.timestamp)
@@ -198,6 +212,12 @@ class TimelineItem(EndpointsModel):
     title = ndb.StringProperty()
     updated = EndpointsDateTimeProperty(auto_now=True)
 
+    def _post_put_hook(self, future):
+        """Keep the search index up to date with every write of a card, once it has been committed"""
+        if future.get_exception() is not None:
+            return
+        ndb.get_context().call_on_commit(lambda: search_index.index_card(self))
+
     def IncludeDeletedSet(self, value):
         """
         If value is true all timelineItems will be returned.
@@ -297,6 +317,7 @@ class Contact(EndpointsModel):
         if not isinstance(value, basestring):
             raise TypeError("ID must be a string.")
 
+        self.user = _request_user()
         self.UpdateFromKey(ndb.Key("User", self.user.email(), Contact, value))
 
     @EndpointsAliasProperty(setter=IdSet, required=True)
@@ -324,6 +345,77 @@ class Subscription(EndpointsModel):
     callbackUrl = ndb.StringProperty(required=True)
 
 
+class UploadSession(ndb.Model):
+    """State of a resumable upload to the upload handlers
+
+    Content is written to the cloud storage file as it is received,
+    the pickled writer only holds the part that isn't aligned to
+    cloud storage blocks yet.
+    """
+
+    owner = ndb.StringProperty(required=True)
+    objectName = ndb.StringProperty(required=True)
+    contentType = ndb.StringProperty(required=True)
+    contentLength = ndb.IntegerProperty()
+    received = ndb.IntegerProperty(default=0)
+    metainfo = ndb.JsonProperty()
+    writer = ndb.PickleProperty()
+    complete = ndb.BooleanProperty(default=False)
+    resultStatus = ndb.IntegerProperty()
+    result = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class AttachmentBlob(ndb.Model):
+    """Attachment content stored in cloud storage, keyed by its SHA-256 hash
+
+    refCount is the number of attachments referencing the content,
+    the file is deleted when it drops to zero.
+
+    processed, renditions and metadata are filled in by the attachment
+    processing queue, renditions maps size names to the IDs of resized
+    versions of images, which are owned by this blob, metadata holds e.g.
+    image dimensions. The garbage collector uses updated to leave blobs
+    alone that have just been referenced again.
+    """
+
+    objectName = ndb.StringProperty(required=True, indexed=False)
+    contentType = ndb.StringProperty(indexed=False)
+    size = ndb.IntegerProperty(indexed=False)
+    refCount = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.BooleanProperty(default=False, indexed=False)
+    renditions = ndb.JsonProperty()
+    metadata = ndb.JsonProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class SweepMark(ndb.Model):
+    """Content that a run of the sweeper found to be in use
+
+    Keyed by "blob:<attachment ID>" or "object:<file name>", run is
+    the ID of the run that marked it, see sweeper.py.
+    """
+
+    run = ndb.StringProperty(indexed=False)
+
+
+class SourceItem(ndb.Model):
+    """The card of a user for a sourceItemId, keyed by source_item_id(user, sourceItemId)
+
+    Read and written in the same transaction as the card by timeline.upsert,
+    so a sourceItemId never gets more than one card.
+    """
+
+    itemId = ndb.IntegerProperty(indexed=False)
+
+
+def source_item_id(user, source_item_id):
+    """Key name of the SourceItem for a user and sourceItemId"""
+
+    return "%s:%s" % (user.email(), source_item_id)
+
+
 class UserAction(messages.Enum):
     """Represents an action taken by the user that triggers a notification."""
     REPLY = 1
@@ -374,3 +466,39 @@ class AttachmentResponse(messages.Message):
 
 class AttachmentList(messages.Message):
     items = messages.MessageField(AttachmentResponse, 1, repeated=True)
+
+
+BundleListRequest = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    bundleId=messages.StringField(2),
+    maxResults=messages.IntegerField(3, default=20),
+    pageToken=messages.StringField(4))
+
+
+class Bundle(messages.Message):
+    """A bundle of timeline cards, represented by its cover and the IDs of the other cards in the bundle"""
+    bundleId = messages.StringField(1)
+    cover = messages.MessageField(TimelineItem.ProtoModel(), 2)
+    itemIds = messages.IntegerField(3, repeated=True)
+    count = messages.IntegerField(4, default=0)
+
+
+class BundleList(messages.Message):
+    items = messages.MessageField(Bundle, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+TimelineSearchRequest = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(2, required=True),
+    maxResults=messages.IntegerField(3, default=20))
+
+
+class DeleteManyRequest(messages.Message):
+    """Cards to delete, either all cards in a bundle and/or a list of card IDs"""
+    bundleId = messages.StringField(1)
+    ids = messages.IntegerField(2, repeated=True)
+
+
+class DeleteManyResponse(messages.Message):
+    ids = messages.IntegerField(1, repeated=True)
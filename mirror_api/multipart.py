@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental parser for multipart/related and multipart/mixed request bodies
+
+The body is read from a stream in fixed-size chunks and the content of each
+part is handed out in chunks as well, so media content can be written to
+storage while it is being received without keeping the whole body in memory.
+
+    reader = MultipartReader(request.body_file, get_boundary(content_type_header))
+    for part in reader:
+        for chunk in part.chunks():
+            ...
+"""
+
+import base64
+import cgi
+
+# Same as the block size used by cloudstorage for resumable writes
+CHUNK_SIZE = 256 * 1024
+
+# Upper limit for the headers of a single part
+_MAX_HEADER_SIZE = 64 * 1024
+
+
+class MultipartError(Exception):
+    """The request body isn't a valid multipart body or can't be decoded"""
+    pass
+
+
+def get_boundary(content_type):
+    """Extract the boundary parameter from a Content-Type header, or None"""
+
+    value, params = cgi.parse_header(content_type)
+    boundary = params.get("boundary")
+    if not boundary:
+        return None
+    return boundary
+
+
+def decode_base64(chunks):
+    """Decode base64 encoded content chunk by chunk, ignoring line breaks
+
+    Raises:
+        MultipartError: if the content isn't valid base64
+    """
+
+    remainder = ""
+    for chunk in chunks:
+        data = remainder + chunk.translate(None, " \t\r\n")
+        # Only complete groups of 4 characters can be decoded
+        usable = len(data) - len(data) % 4
+        remainder = data[usable:]
+        if usable > 0:
+            try:
+                yield base64.b64decode(data[:usable])
+            except TypeError as e:
+                raise MultipartError("Invalid base64 content. %s" % e)
+
+    if remainder:
+        raise MultipartError("Invalid base64 content. Incomplete data")
+
+
+class Part(object):
+    """A single part of a multipart body
+
+    The content can only be read once, either with chunks() or read().
+    """
+
+    def __init__(self, headers, chunks):
+        self.headers = headers
+        self._chunks = chunks
+
+    @property
+    def content_type(self):
+        content_type = self.headers.get("content-type", "text/plain")
+        return content_type.split(";")[0].strip().lower()
+
+    @property
+    def transfer_encoding(self):
+        return self.headers.get("content-transfer-encoding", "").strip().lower()
+
+    def chunks(self):
+        """Iterate over the content of the part in chunks of at most CHUNK_SIZE bytes"""
+        return self._chunks
+
+    def read(self):
+        """Read the complete content of the part, only use for small parts"""
+        return "".join(self._chunks)
+
+
+class MultipartReader(object):
+    """Iterates over the parts of a multipart body read from stream"""
+
+    def __init__(self, stream, boundary, chunk_size=CHUNK_SIZE):
+        self._stream = stream
+        self._delimiter = "\r\n--" + boundary
+        self._chunk_size = chunk_size
+        # Prepend CRLF so that the first delimiter can be found like all others
+        self._buffer = "\r\n"
+        self._eof = False
+
+    def _fill(self):
+        """Read the next chunk from the stream, returns False at the end of the stream"""
+
+        if self._eof:
+            return False
+
+        data = self._stream.read(self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+
+        self._buffer += data
+        return True
+
+    def _find(self, pattern, limit=None):
+        """Read from the stream until pattern is in the buffer and return its position"""
+
+        start = 0
+        while True:
+            pos = self._buffer.find(pattern, start)
+            if pos != -1:
+                return pos
+            if limit is not None and len(self._buffer) > limit:
+                raise MultipartError("Headers of multipart body too long")
+            start = max(0, len(self._buffer) - len(pattern) + 1)
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+
+    def _skip_preamble(self):
+        """Discard everything up to the first delimiter"""
+
+        keep = len(self._delimiter) - 1
+        while True:
+            pos = self._buffer.find(self._delimiter)
+            if pos != -1:
+                self._buffer = self._buffer[pos:]
+                return
+            self._buffer = self._buffer[-keep:]
+            if not self._fill():
+                raise MultipartError("No parts found in multipart body")
+
+    def _read_headers(self):
+        """Parse the headers of a part, the buffer has to start after the delimiter line"""
+
+        if self._buffer.startswith("\r\n"):
+            self._buffer = self._buffer[2:]
+            return {}
+
+        end = self._find("\r\n\r\n", _MAX_HEADER_SIZE)
+        lines = self._buffer[:end].split("\r\n")
+        self._buffer = self._buffer[end + 4:]
+
+        headers = {}
+        for line in lines:
+            if ":" not in line:
+                continue
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+
+        return headers
+
+    def _part_chunks(self):
+        """Generate the content of the current part up to the next delimiter"""
+
+        keep = len(self._delimiter) - 1
+        while True:
+            pos = self._buffer.find(self._delimiter)
+            if pos != -1:
+                data = self._buffer[:pos]
+                self._buffer = self._buffer[pos:]
+                if data:
+                    yield data
+                return
+
+            # Hold back enough data to recognize a delimiter split between chunks
+            if len(self._buffer) > keep:
+                data = self._buffer[:-keep]
+                self._buffer = self._buffer[-keep:]
+                yield data
+
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+
+    def __iter__(self):
+        self._skip_preamble()
+
+        while True:
+            # The buffer starts with a delimiter here
+            self._buffer = self._buffer[len(self._delimiter):]
+            while len(self._buffer) < 2:
+                if not self._fill():
+                    raise MultipartError("Unexpected end of multipart body")
+
+            if self._buffer.startswith("--"):
+                # Closing delimiter, ignore the epilogue
+                return
+
+            # Skip optional whitespace after the boundary
+            end = self._find("\r\n", _MAX_HEADER_SIZE)
+            self._buffer = self._buffer[end + 2:]
+
+            part = Part(self._read_headers(), self._part_chunks())
+            yield part
+
+            # Skip content the caller didn't read
+            for chunk in part.chunks():
+                pass
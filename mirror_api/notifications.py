@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Notifications to subscriptions, shared by the API and the task handlers"""
+
+import json
+import logging
+import sys
+import urllib2
+
+from models import Subscription
+
+
+def notify_subscriptions(user, operation, data):
+    """Send a notification with data to all subscriptions of user for the collection and operation"""
+
+    data["operation"] = operation.name
+
+    header = {"Content-type": "application/json"}
+
+    query = Subscription.query().filter(Subscription.user == user)
+    query = query.filter(Subscription.collection == data["collection"])
+    query = query.filter(Subscription.operation == operation)
+    for subscription in query.fetch():
+        data["userToken"] = subscription.userToken
+        data["verifyToken"] = subscription.verifyToken
+
+        req = urllib2.Request(subscription.callbackUrl, json.dumps(data), header)
+        try:
+            urllib2.urlopen(req)
+        except:
+            logging.error(sys.exc_info()[0])
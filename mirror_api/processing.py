@@ -0,0 +1,138 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background processing of uploaded attachments
+
+Upload requests only store the raw content and add the attachment with
+isProcessingContent set. A task on the attachments queue (see queue.yaml)
+then runs the processors for the content type once per content, and the
+task handler clears the flag on the card.
+"""
+
+# Add the library location to the path
+import sys
+sys.path.insert(0, 'lib')
+
+import attachments
+import cloudstorage as gcs
+import cStringIO
+import json
+import logging
+import renditions
+
+from google.appengine.api import taskqueue
+from PIL import Image
+
+QUEUE_NAME = "attachments"
+
+PROCESS_URL = "/tasks/process"
+
+# Most tasks a transaction can add
+_MAX_TRANSACTIONAL_TASKS = 5
+
+
+def _process_image(content):
+    """Extract the dimensions of an image and create its renditions"""
+
+    im = Image.open(cStringIO.StringIO(content))
+    width, height = im.size
+    metadata = {"width": width, "height": height, "format": im.format}
+
+    # Let the JPEG decoder scale down while decoding instead of decoding the full image
+    im.draft("RGB", max(renditions.SIZES.values()))
+
+    return renditions.create_renditions(im, width, height), metadata
+
+
+# Processors by content type prefix, each gets the content and returns
+# the renditions and metadata to store for it. Audio and video are kept
+# as uploaded, there is no transcoder available on App Engine.
+_PROCESSORS = [
+    ("image/", _process_image)
+]
+
+
+def _get_processor(content_type):
+    for prefix, processor in _PROCESSORS:
+        if content_type.startswith(prefix):
+            return processor
+    return None
+
+
+def needs_processing(uploads):
+    """The uploads that have to go through the processing queue before they are complete
+
+    uploads is a list of (attachment ID, content type).
+    """
+
+    uploads = [upload for upload in uploads if _get_processor(upload[1]) is not None]
+    if not uploads:
+        return []
+
+    pending = attachments.unprocessed([attachment_id for attachment_id, content_type in uploads])
+    return [upload for upload in uploads if upload[0] in pending]
+
+
+def queue(card_id, uploads, transactional=False):
+    """Process attachments of a card in the background, uploads is a list of (attachment ID, content type)
+
+    With transactional the tasks are only added if the current datastore
+    transaction commits. If there are more uploads than a transaction can
+    add tasks for, a single task is added that queues the others.
+    """
+
+    if transactional and len(uploads) > _MAX_TRANSACTIONAL_TASKS:
+        task = taskqueue.Task(url=PROCESS_URL, params={"itemId": card_id, "uploads": json.dumps(uploads)})
+        taskqueue.Queue(QUEUE_NAME).add(task, transactional=True)
+        return
+
+    tasks = [taskqueue.Task(url=PROCESS_URL,
+                            params={"itemId": card_id, "attachmentId": attachment_id, "contentType": content_type})
+             for attachment_id, content_type in uploads]
+    taskqueue.Queue(QUEUE_NAME).add(tasks, transactional=transactional)
+
+
+def process(attachment_id, content_type, give_up=False):
+    """Run the processor for the content, does nothing if it has been processed already
+
+    With give_up the attachment is marked as processed without results,
+    for content that keeps failing.
+    """
+
+    if attachments.is_processed(attachment_id):
+        return
+
+    results = {}
+    metadata = {}
+    processor = _get_processor(content_type)
+    if processor is not None and not give_up:
+        try:
+            path, created = attachments.object_info(attachment_id)
+            gcs_file = gcs.open(path, 'r')
+            content = gcs_file.read()
+            gcs_file.close()
+        except gcs.NotFoundError:
+            # Deleted before it could be processed
+            return
+
+        try:
+            results, metadata = processor(content)
+        except IOError as e:
+            # Content the processor can't decode, the original is served for all sizes
+            logging.warning("Couldn't process attachment %s: %s" % (attachment_id, e))
+
+    if not attachments.finish_processing(attachment_id, results, metadata):
+        for rendition_id in results.values():
+            attachments.release(rendition_id)
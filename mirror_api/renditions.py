@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resized renditions of image attachments
+
+Glass only displays 640x360 pixels, so full resolution camera images are
+scaled down once while processing the upload and stored as progressive JPEGs.
+Clients pick a rendition with the size parameter of the download URL,
+e.g. ?size=display, and get the original until it has been created.
+"""
+
+# Add the library location to the path
+import sys
+sys.path.insert(0, 'lib')
+
+import attachments
+import cStringIO
+
+from PIL import Image
+from PIL import ImageFile
+
+# Size names accepted by the download URL and the box each rendition fits into
+SIZES = {
+    "display": (640, 360),
+    "thumbnail": (320, 180)
+}
+
+_JPEG_QUALITY = 85
+
+# Progressive JPEGs have to be written in one block
+ImageFile.MAXBLOCK = 2 ** 20
+
+
+def get_rendition(attachment_id, size):
+    """ID of the content to serve for size, the original if there is no rendition"""
+
+    renditions = attachments.get_renditions(attachment_id)
+    if not renditions or size not in renditions:
+        return attachment_id
+
+    return renditions[size]
+
+
+def _resize(im, box):
+    """Scale im down to fit into box and encode it as progressive JPEG"""
+
+    im = im.copy()
+    im.thumbnail(box, Image.ANTIALIAS)
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    f = cStringIO.StringIO()
+    im.save(f, "JPEG", quality=_JPEG_QUALITY, optimize=True, progressive=True)
+    content = f.getvalue()
+    f.close()
+
+    return content
+
+
+def create_renditions(im, width, height):
+    """Store all renditions that are smaller than the original image
+
+    width and height are the size of the original, im may already be
+    in draft mode. Returns the IDs of the renditions by size name.
+    """
+
+    renditions = {}
+    for size, box in SIZES.items():
+        if width <= box[0] and height <= box[1]:
+            # The original is small enough already
+            continue
+        renditions[size] = attachments.store([_resize(im, box)], "image/jpeg")
+
+    return renditions
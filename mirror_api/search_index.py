@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Full-text search index for timeline cards using the App Engine Search API"""
+
+import logging
+import re
+
+from HTMLParser import HTMLParser
+from google.appengine.api import search
+
+_INDEX_NAME = "timeline"
+
+_TEXT_FIELDS = ("text", "title", "speakableText")
+
+_TAGS = re.compile(r"<[^>]*>")
+
+# Largest limit the Search API accepts for a query
+MAX_RESULTS = 1000
+
+
+def _strip_html(html):
+    """Remove all tags from html, leaving only the text content"""
+
+    return HTMLParser().unescape(_TAGS.sub(" ", html))
+
+
+def _doc_id(card):
+    return str(card.key.integer_id())
+
+
+def index_card(card):
+    """Add or update the search document for a card, or remove it for deleted cards
+
+    Called after the card has been written, so errors are only logged and
+    the document stays outdated until the next write of the card.
+    """
+
+    try:
+        if card.isDeleted:
+            remove_card(card)
+        else:
+            _put_card(card)
+    except search.Error:
+        logging.exception("Failed to update the search document for card %s" % _doc_id(card))
+
+
+def _put_card(card):
+    """Add or update the search document for a card"""
+
+    fields = [search.AtomField(name="user", value=card.user.email())]
+    for field in _TEXT_FIELDS:
+        value = getattr(card, field)
+        if value:
+            fields.append(search.TextField(name=field, value=value))
+    if card.html:
+        fields.append(search.TextField(name="html", value=_strip_html(card.html)))
+
+    result = search.Index(name=_INDEX_NAME).put(search.Document(doc_id=_doc_id(card), fields=fields))[0]
+    if result.code != search.OperationResult.OK:
+        logging.error("Failed to index card %s: %s %s" % (_doc_id(card), result.code, result.message))
+
+
+def remove_card(card):
+    """Remove the search document for a card"""
+
+    search.Index(name=_INDEX_NAME).delete(_doc_id(card))
+
+
+def search_cards(user, query_string, limit):
+    """Search the cards of user, returns a list of card IDs
+
+    Raises:
+        search.QueryError: if query_string isn't a valid search query
+    """
+
+    query = search.Query(
+        query_string="user:\"%s\" AND (%s)" % (user.email(), query_string),
+        options=search.QueryOptions(limit=limit, ids_only=True)
+    )
+
+    return [int(document.doc_id) for document in search.Index(name=_INDEX_NAME).search(query)]
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Garbage collection of attachment content that no card references anymore
+
+Content can be orphaned when a card update fails after the upload has
+been stored, or when an upload session is abandoned. The sweeper marks
+everything that is still referenced, then deletes the rest. Only files and
+blobs older than GRACE_PERIOD are deleted, so uploads in progress are safe.
+
+A run is a chain of tasks on the sweeper queue (see queue.yaml), each
+handling one page of one phase:
+
+    cards     mark content referenced by cards, with its renditions
+    sessions  mark files of upload sessions in progress, delete old sessions
+    recent    mark blobs that have been referenced again, with their renditions
+    blobs     delete blobs that haven't been marked, mark the files of the others
+    objects   delete files that haven't been marked
+    marks     delete marks left over from earlier runs
+
+Marks are SweepMark entities holding the ID of the run, so no more than
+one page has to be kept in memory.
+"""
+
+# Add the library location to the path
+import sys
+sys.path.insert(0, 'lib')
+
+import calendar
+import cloudstorage as gcs
+import datetime
+import hashlib
+import json
+
+from attachments import bucket
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import AttachmentBlob
+from models import SweepMark
+from models import TimelineItem
+from models import UploadSession
+
+GRACE_PERIOD = datetime.timedelta(days=1)
+
+QUEUE_NAME = "sweeper"
+
+STEP_URL = "/tasks/sweep/step"
+
+_PAGE_SIZE = 200
+
+# Runs are identified by their start time
+_RUN_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def _blob_mark(blob_id):
+    return ndb.Key(SweepMark, "blob:" + blob_id)
+
+
+def _object_mark(object_name):
+    return ndb.Key(SweepMark, "object:" + object_name)
+
+
+def _is_marked(mark, run):
+    return mark is not None and mark.run == run
+
+
+def _mark(keys, run):
+    ndb.put_multi([SweepMark(key=key, run=run) for key in set(keys)])
+
+
+def _fetch_page(query, cursor, **kwargs):
+    """One page of query results and the cursor for the next one, None after the last page"""
+
+    start_cursor = Cursor(urlsafe=cursor) if cursor is not None else None
+    results, cursor, more = query.fetch_page(_PAGE_SIZE, start_cursor=start_cursor, **kwargs)
+    return results, cursor.urlsafe() if more and cursor is not None else None
+
+
+def _mark_content(attachment_ids, run):
+    """Mark attachment content and its renditions"""
+
+    keys = []
+    blobs = ndb.get_multi([ndb.Key(AttachmentBlob, attachment_id) for attachment_id in attachment_ids])
+    for attachment_id, blob in zip(attachment_ids, blobs):
+        if blob is None:
+            # Attachment from before content-addressed storage, named like the file
+            keys.append(_object_mark(attachment_id))
+            continue
+        keys.append(_blob_mark(attachment_id))
+        if blob.renditions:
+            keys.extend(_blob_mark(rendition) for rendition in blob.renditions.values())
+
+    _mark(keys, run)
+
+
+@ndb.transactional
+def _delete_blob(blob_id, cutoff):
+    """Delete an unreferenced blob unless it has been used since cutoff"""
+
+    blob = ndb.Key(AttachmentBlob, blob_id).get()
+    if blob is None:
+        return True
+    if (blob.updated or blob.created) > cutoff:
+        return False
+
+    blob.key.delete()
+    return True
+
+
+def _sweep_cards(run, cutoff, cursor, report):
+    cards, cursor = _fetch_page(TimelineItem.query(TimelineItem.isDeleted == False), cursor)
+
+    attachment_ids = set()
+    for card in cards:
+        if card.attachments is not None:
+            for att in card.attachments:
+                attachment_ids.add(att.id)
+    _mark_content(list(attachment_ids), run)
+
+    return cursor
+
+
+def _sweep_sessions(run, cutoff, cursor, report):
+    sessions, cursor = _fetch_page(UploadSession.query(), cursor)
+
+    keys = []
+    old = []
+    for session in sessions:
+        if session.created > cutoff:
+            if not session.complete:
+                keys.append(_object_mark(session.objectName))
+        else:
+            # Abandoned or long finished, an incomplete file is removed with the other orphans
+            old.append(session.key)
+
+    _mark(keys, run)
+    ndb.delete_multi(old)
+    report["sessions"] += len(old)
+
+    return cursor
+
+
+def _sweep_recent(run, cutoff, cursor, report):
+    keys, cursor = _fetch_page(AttachmentBlob.query(AttachmentBlob.updated > cutoff), cursor, keys_only=True)
+    _mark_content([key.id() for key in keys], run)
+
+    return cursor
+
+
+def _sweep_blobs(run, cutoff, cursor, report):
+    blobs, cursor = _fetch_page(AttachmentBlob.query(), cursor)
+    marks = ndb.get_multi([_blob_mark(blob.key.id()) for blob in blobs])
+
+    keys = []
+    deleted = []
+    for blob, mark in zip(blobs, marks):
+        if _is_marked(mark, run) or not _delete_blob(blob.key.id(), cutoff):
+            keys.append(_object_mark(blob.objectName))
+            # Renditions of a blob that has just been referenced again are kept with it
+            if blob.renditions:
+                keys.extend(_blob_mark(rendition) for rendition in blob.renditions.values())
+        else:
+            report["blobs"] += 1
+            if mark is not None:
+                deleted.append(mark.key)
+
+    _mark(keys, run)
+    ndb.delete_multi(deleted)
+
+    return cursor
+
+
+def _sweep_objects(run, cutoff, cursor, report):
+    cutoff_timestamp = calendar.timegm(cutoff.utctimetuple())
+
+    page = list(gcs.listbucket(bucket + "/", marker=cursor, max_keys=_PAGE_SIZE))
+    names = [stat.filename[len(bucket) + 1:] for stat in page]
+    marks = ndb.get_multi([_object_mark(name) for name in names])
+
+    deleted = []
+    for stat, mark in zip(page, marks):
+        if _is_marked(mark, run) or stat.st_ctime > cutoff_timestamp:
+            continue
+        try:
+            gcs.delete(stat.filename)
+        except gcs.NotFoundError:
+            continue
+        report["objects"] += 1
+        report["bytes"] += stat.st_size
+        if mark is not None:
+            deleted.append(mark.key)
+
+    ndb.delete_multi(deleted)
+
+    if len(page) < _PAGE_SIZE:
+        return None
+    return page[-1].filename
+
+
+def _sweep_marks(run, cutoff, cursor, report):
+    marks, cursor = _fetch_page(SweepMark.query(), cursor)
+    ndb.delete_multi([mark.key for mark in marks if mark.run != run])
+
+    return cursor
+
+
+_PHASES = [
+    ("cards", _sweep_cards),
+    ("sessions", _sweep_sessions),
+    ("recent", _sweep_recent),
+    ("blobs", _sweep_blobs),
+    ("objects", _sweep_objects),
+    ("marks", _sweep_marks)
+]
+
+
+def _queue_step(run, phase, cursor, report):
+    params = {"run": run, "phase": phase, "report": json.dumps(report)}
+    if cursor is not None:
+        params["cursor"] = cursor
+
+    # Named after the step, so a retried task can't fork the chain
+    name = "sweep-" + hashlib.sha1("%s|%s|%s" % (run, phase, cursor)).hexdigest()
+    try:
+        taskqueue.add(queue_name=QUEUE_NAME, url=STEP_URL, name=name, params=params)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def start():
+    """Start a run of the sweeper"""
+
+    run = datetime.datetime.utcnow().strftime(_RUN_FORMAT)
+    report = {"objects": 0, "bytes": 0, "blobs": 0, "sessions": 0}
+    _queue_step(run, _PHASES[0][0], None, report)
+    return run
+
+
+def step(run, phase, cursor, report):
+    """Handle one page of a run and queue the next one
+
+    Returns the report of what has been removed after the last page, None before.
+    """
+
+    cutoff = datetime.datetime.strptime(run, _RUN_FORMAT) - GRACE_PERIOD
+
+    names = [name for name, function in _PHASES]
+    index = names.index(phase)
+    cursor = _PHASES[index][1](run, cutoff, cursor, report)
+
+    if cursor is None:
+        index += 1
+        if index == len(_PHASES):
+            return report
+
+    _queue_step(run, _PHASES[index][0], cursor, report)
+    return None
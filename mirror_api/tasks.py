@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Task queue and cron handlers for attachment processing and clean-up"""
+
+__author__ = 'scarygami@gmail.com (Gerwin Sturm)'
+
+# Add the library location to the path
+import sys
+sys.path.insert(0, 'lib')
+
+import json
+import logging
+import notifications
+import processing
+import sweeper
+import webapp2
+
+from google.appengine.api import channel
+from google.appengine.ext import ndb
+
+from models import Operation
+from models import TimelineItem
+
+# Same as task_retry_limit of the attachments queue in queue.yaml
+_MAX_RETRIES = 5
+
+
+@ndb.transactional
+def _finish_processing(card_id, attachment_id):
+    """Clear isProcessingContent for the attachment, returns the card if it changed"""
+
+    card = ndb.Key(TimelineItem, card_id).get()
+    if card is None or card.isDeleted or card.attachments is None:
+        return None
+
+    changed = False
+    for att in card.attachments:
+        if att.id == attachment_id and att.isProcessingContent:
+            att.isProcessingContent = False
+            changed = True
+
+    if not changed:
+        return None
+
+    card.put()
+    return card
+
+
+class ProcessHandler(webapp2.RequestHandler):
+
+    def post(self):
+        card_id = int(self.request.get("itemId"))
+
+        uploads = self.request.get("uploads")
+        if uploads:
+            # Queued in place of more tasks than the card's transaction could add
+            processing.queue(card_id, json.loads(uploads))
+            return
+
+        attachment_id = self.request.get("attachmentId")
+        content_type = self.request.get("contentType")
+
+        retries = int(self.request.headers.get("X-AppEngine-TaskRetryCount", 0))
+        try:
+            processing.process(attachment_id, content_type)
+        except:
+            if retries < _MAX_RETRIES:
+                raise
+            # Last attempt, complete the card with the original content only
+            logging.exception("Giving up processing attachment %s" % attachment_id)
+            processing.process(attachment_id, content_type, give_up=True)
+
+        card = _finish_processing(card_id, attachment_id)
+        if card is None:
+            return
+
+        # Notify Glass emulator
+        channel.send_message(card.user.email(), json.dumps({"id": card.id}))
+
+        # Notify timeline UPDATE subscriptions
+        data = {}
+        data["collection"] = "timeline"
+        data["itemId"] = card.id
+        notifications.notify_subscriptions(card.user, Operation.UPDATE, data)
+
+
+class SweepHandler(webapp2.RequestHandler):
+    """Run by cron.yaml to delete attachment content that isn't referenced anymore"""
+
+    def get(self):
+        run = sweeper.start()
+
+        self.response.content_type = "application/json"
+        self.response.out.write(json.dumps({"run": run}))
+
+
+class SweepStepHandler(webapp2.RequestHandler):
+    """One page of a run of the sweeper, queued by sweeper.start and the previous step"""
+
+    def post(self):
+        run = self.request.get("run")
+        phase = self.request.get("phase")
+        cursor = self.request.get("cursor", None)
+        report = json.loads(self.request.get("report"))
+
+        report = sweeper.step(run, phase, cursor, report)
+        if report is None:
+            return
+
+        logging.info("Reclaimed %(bytes)s bytes in %(objects)s files, removed %(blobs)s blobs "
+                     "and %(sessions)s upload sessions" % report)
+
+
+app = webapp2.WSGIApplication(
+    [
+        (processing.PROCESS_URL, ProcessHandler),
+        ("/tasks/sweep", SweepHandler),
+        (sweeper.STEP_URL, SweepStepHandler)
+    ],
+    debug=True
+)
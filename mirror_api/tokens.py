@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Verification of OAuth access tokens shared by the API and the upload handlers
+
+A token is checked once against the tokeninfo endpoint, the user it
+belongs to is then cached in memcache until the token expires, so
+repeated requests with the same token don't need another round-trip.
+Tokens that tokeninfo rejects are cached for _REJECTED_TIME, and ID tokens
+aren't sent to it at all, Cloud Endpoints verifies those locally.
+
+get_request_user resolves the user of a Cloud Endpoints request once and
+keeps it in os.environ, which App Engine keeps separate for each request.
+Cloud Endpoints keeps its own user there as well.
+"""
+
+import endpoints
+import hashlib
+import json
+import os
+import urllib
+import utils
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.api import users
+
+_TOKENINFO_URL = "https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s"
+
+_NAMESPACE = "tokens"
+
+# Seconds to remember that a token isn't valid for this API
+_REJECTED_TIME = 5 * 60
+
+# Keys in os.environ for the user of the current request and the header it was resolved from
+_ENVIRON_USER = "MIRROR_API_USER"
+_ENVIRON_AUTHORIZATION = "MIRROR_API_USER_AUTHORIZATION"
+
+# Same scope and client IDs as accepted by the Cloud Endpoints API
+_SCOPE = "https://www.googleapis.com/auth/userinfo.email"
+_CLIENT_IDs = [endpoints.API_EXPLORER_CLIENT_ID, utils.CLIENT_ID] + utils.ADDITIONAL_CLIENT_IDS
+
+
+def _parse_token(authorization):
+    """Extract the access token from an Authorization header, or None"""
+
+    if not authorization:
+        return None
+
+    parts = authorization.split(" ", 1)
+    if len(parts) != 2 or parts[0].lower() not in ("bearer", "oauth"):
+        return None
+
+    return parts[1].strip()
+
+
+def _is_id_token(token):
+    """ID tokens are JWTs, three base64 encoded segments separated by dots"""
+
+    return token.count(".") == 2
+
+
+def _verify(token):
+    """
+    Check a token with the tokeninfo endpoint
+
+    Returns the email and remaining lifetime, an empty email for tokens
+    that aren't valid for this API, or None if tokeninfo couldn't be reached.
+    """
+
+    rejected = ("", _REJECTED_TIME)
+
+    try:
+        result = urlfetch.fetch(_TOKENINFO_URL % urllib.quote(token), deadline=10)
+    except urlfetch.Error:
+        return None
+
+    if result.status_code >= 500:
+        return None
+    if result.status_code != 200:
+        return rejected
+
+    info = json.loads(result.content)
+    if info.get("issued_to") not in _CLIENT_IDs:
+        return rejected
+    if _SCOPE not in info.get("scope", "").split(" "):
+        return rejected
+
+    email = info.get("email")
+    expires_in = int(info.get("expires_in", 0))
+    if not email or expires_in <= 0:
+        return rejected
+
+    return email, expires_in
+
+
+def get_current_user(authorization=None):
+    """User the access token in an Authorization header belongs to, None if it isn't valid
+
+    Without authorization the header of the current Cloud Endpoints request is used.
+    """
+
+    if authorization is None:
+        authorization = os.environ.get("HTTP_AUTHORIZATION")
+
+    token = _parse_token(authorization)
+    if token is None or _is_id_token(token):
+        return None
+
+    # Access tokens aren't used as keys directly
+    cache_key = hashlib.sha256(token).hexdigest()
+    email = memcache.get(cache_key, namespace=_NAMESPACE)
+    if email is None:
+        verified = _verify(token)
+        if verified is None:
+            return None
+        email, expires_in = verified
+        memcache.set(cache_key, email, time=expires_in, namespace=_NAMESPACE)
+
+    if not email:
+        return None
+
+    # Same representation of the user as Cloud Endpoints
+    return users.User(email=email)
+
+
+def get_request_user():
+    """User of the current Cloud Endpoints request, None if it isn't authenticated
+
+    Resolved once per request from the token cache, or by Cloud Endpoints
+    for anything the cache can't verify, e.g. ID tokens.
+    """
+
+    authorization = os.environ.get("HTTP_AUTHORIZATION", "")
+    if _ENVIRON_USER in os.environ and os.environ.get(_ENVIRON_AUTHORIZATION) == authorization:
+        email = os.environ[_ENVIRON_USER]
+        return users.User(email=email) if email else None
+
+    user = get_current_user(authorization)
+    if user is None:
+        user = endpoints.get_current_user()
+
+    os.environ[_ENVIRON_AUTHORIZATION] = authorization
+    os.environ[_ENVIRON_USER] = user.email() if user is not None else ""
+    return user
@@ -21,22 +21,36 @@ __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 import sys
 sys.path.insert(0, 'lib')
 
+import attachments
+import calendar
 import cloudstorage as gcs
-import email
-import httplib2
+import cards
+import email.utils
+import endpoints
+import idempotency
 import json
+import logging
+import multipart
 import os
+import re
+import processing
+import renditions
+import tokens
 import utils
 import uuid
 import webapp2
 
+from endpoints import protojson
 from google.appengine.api import app_identity
+from google.appengine.api import channel
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
+from protorpc import messages
 
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-from oauth2client.client import AccessTokenCredentials
+from models import TimelineItem
+from models import UploadSession
 
 my_default_retry_params = gcs.RetryParams(initial_delay=0.2,
                                           max_delay=5.0,
@@ -47,256 +61,634 @@ gcs.set_default_retry_params(my_default_retry_params)
 
 bucket = "/" + os.environ.get("BUCKET_NAME", app_identity.get_default_gcs_bucket_name())
 
+_CONTENT_RANGE = re.compile(r"^bytes (?:\*|(\d+)-(\d+))/(\*|\d+)$")
+
+# Seconds a request may hold the lock of an upload session, the request deadline
+_SESSION_LOCK_TIME = 60
+
+_PROTOJSON = protojson.EndpointsProtoJson()
+
+# Attachment URLs always return the same content, but require authentication
+_CACHE_CONTROL = "private, max-age=31536000"
+
+# For the original served in place of a rendition that is still being created
+_PENDING_CACHE_CONTROL = "private, no-cache"
+
+
+def _http_date(value):
+    """Format a naive UTC datetime for HTTP headers"""
+
+    return email.utils.formatdate(calendar.timegm(value.utctimetuple()), usegmt=True)
+
+
+def _is_media(content_type):
+    return content_type.startswith("image/") or content_type.startswith("audio/") or content_type.startswith("video/")
+
+
+def _read_chunks(stream):
+    """Iterate over a stream in chunks of multipart.CHUNK_SIZE bytes"""
+
+    while True:
+        data = stream.read(multipart.CHUNK_SIZE)
+        if not data:
+            return
+        yield data
+
+
+def _store_attachment(chunks, content_type, base64=False):
+    """Write media content to cloud storage chunk by chunk, returns the attachment id
+
+    Raises:
+        multipart.MultipartError: if base64 encoded content can't be decoded
+    """
+
+    if base64:
+        chunks = multipart.decode_base64(chunks)
+
+    return attachments.store(chunks, content_type)
+
+
+def _card_from_metainfo(metainfo):
+    """Convert the metainfo of an upload to a TimelineItem the same way the API does
+
+    Raises:
+        ValueError, messages.Error: if metainfo isn't a valid card
+    """
+
+    if metainfo is None:
+        metainfo = {}
+    if not isinstance(metainfo, dict):
+        raise ValueError("Metainfo has to be a JSON object.")
+    metainfo = dict((key, value) for key, value in metainfo.items() if key not in ("id", "attachments"))
+
+    message = _PROTOJSON.decode_message(TimelineItem.ProtoModel(), json.dumps(metainfo))
+    return TimelineItem.FromMessage(message)
+
+
+def _new_attachments(card_id, uploads, pending):
+    """Attachments of a card for uploads, the ones in pending are marked as processing"""
+
+    return [TimelineItem.Attachment(
+        id=attachment_id,
+        contentType=content_type,
+        contentUrl="%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, card_id, attachment_id),
+        isProcessingContent=(attachment_id, content_type) in pending
+    ) for attachment_id, content_type in uploads]
+
+
+@ndb.transactional
+def _put_card(card, pending):
+    """Store a new card and queue processing of pending uploads, either both or neither happen"""
+
+    card.put()
+    if pending:
+        processing.queue(card.key.integer_id(), pending, transactional=True)
+
+
+@ndb.transactional
+def _update_card(card_id, user, uploads, pending, fields=None):
+    """Add uploads to a stored card, returns the card or None if it doesn't exist anymore
+
+    The card is read again in the transaction, so attachments added by concurrent
+    uploads and isProcessingContent cleared by the processing queue aren't lost.
+    fields is a card whose values are set on the stored card as well.
+    """
+
+    card = ndb.Key(TimelineItem, card_id).get()
+    if card is None or card.user != user or card.isDeleted:
+        return None
+
+    if fields is not None:
+        cards.copy_card_fields(fields, card)
+    if card.attachments is None:
+        card.attachments = []
+    card.attachments.extend(_new_attachments(card_id, uploads, pending))
+
+    card.put()
+    if pending:
+        processing.queue(card_id, pending, transactional=True)
+
+    return card
+
+
 class UploadHandler(webapp2.RequestHandler):
 
+    # List of (attachment ID, content type) for all media content in the request
+    _uploads = None
+
+    # Uploads that have to go through the processing queue
+    _processing = None
+
     _metainfo = None
-    _content_type = None
-    _content = None
-    _token = None
-    _service = None
+    _user = None
+    _scope = None
+
+    # Set to True for handlers that honour the Idempotency-Key header
+    _idempotent = False
+
+    # Set to True for the insert and update handlers, which accept resumable uploads
+    _resumable = False
 
     def dispatch(self):
+        self._uploads = []
+        self._processing = []
+
         self._checkauth()
-        self._decode()
-        if self._token is None:
+        if self._user is None:
             self.abort(401)
-        else:
-            credentials = AccessTokenCredentials(self._token, "mirror-api-upload-handler/1.0")
-            http = httplib2.Http()
-            http = credentials.authorize(http)
-            http.timeout = 60
-            self._service = build("mirror", "v1", http=http, discoveryServiceUrl=utils.discovery_service_url)
-            super(UploadHandler, self).dispatch()
-
-    def _checkauth(self):
-        if "Authorization" in self.request.headers:
-            self._token = self.request.headers["Authorization"].split(" ")[1]
 
-    def _decode(self):
-        """Check for valid content types and decode data accordingly"""
+        # Kept apart from the API so keys used for both can't return the wrong result
+        self._scope = "upload:" + self._user.email()
 
-        content_type = self.request.content_type
-        if content_type == "multipart/related" or content_type == "multipart/mixed":
-            # Attach content-type header to body so that email library can decode it correctly
-            message = "Content-Type: " + self.request.headers["Content-Type"] + "\r\n"
-            message += self.request.body
-
-            msg = email.message_from_string(message)
+        if self._resumable:
+            # Content of a resumable upload is sent with PUT to the session URI on the same route
+            upload_id = self.request.GET.get("upload_id")
+            if upload_id is not None and self.request.method == "PUT":
+                self._resume_upload(upload_id)
+                return
 
-            if not msg.is_multipart():
+            if self.request.GET.get("uploadType") == "resumable" and self.request.method in ("POST", "PUT"):
+                self._start_upload()
                 return
 
-            for payload in msg.get_payload():
-                content_type = payload.get_content_type()
-                if content_type.startswith("image/") or content_type.startswith("audio/") or content_type.startswith("video/"):
-                    if self._content is None:
-                        self._content_type = content_type
-                        self._content = payload.get_payload(decode=True)
-                elif content_type == "application/json":
-                    if self._metainfo is None:
-                        self._metainfo = json.loads(payload.get_payload())
+        idempotency_key = None
+        if self._idempotent:
+            idempotency_key = self.request.headers.get(idempotency.HEADER)
+
+        if idempotency_key is not None:
+            result = idempotency.begin(self._scope, idempotency_key)
+            if result is not None:
+                self.response.content_type = "application/json"
+                if result == idempotency.PENDING:
+                    self.response.status = 409
+                    self.response.out.write(utils.createError(409, "A request with the same Idempotency-Key is still being processed."))
+                else:
+                    self.response.status = 200
+                    self.response.out.write(result)
+                return
 
-            return
+        try:
+            try:
+                self._decode()
+            except multipart.MultipartError as e:
+                self._discard_attachments()
+                self.response.content_type = "application/json"
+                self.response.status = 400
+                self.response.out.write(utils.createError(400, "Couldn't decode request body. %s" % e))
+                if idempotency_key is not None:
+                    idempotency.abort(self._scope, idempotency_key)
+                return
 
-        if content_type.startswith("image/") or content_type.startswith("audio/") or content_type.startswith("video/"):
-            self._content_type = content_type
-            if "Content-Transfer-Encoding" in self.request.headers and self.request.headers["Content-Transfer-Encoding"].lower() == "base64":
-                self._content = self.request.body.decode("base64")
+            super(UploadHandler, self).dispatch()
+        except:
+            self._discard_attachments()
+            if idempotency_key is not None:
+                idempotency.abort(self._scope, idempotency_key)
+            raise
+
+        if idempotency_key is not None:
+            if self.response.status_int == 200:
+                idempotency.finish(self._scope, idempotency_key, self.response.body)
             else:
-                self._content = self.request.body
+                idempotency.abort(self._scope, idempotency_key)
 
+    def _upload(self, *args):
+        """Attach the decoded content to a card, implemented by the upload handlers"""
+        self.abort(405)
 
-class InsertHandler(UploadHandler):
+    def _start_upload(self):
+        """Create a new session for a resumable upload
 
-    def post(self):
+        The metainfo for the card is sent in the body of this request,
+        the media content in one or more following PUT requests to the
+        session URI returned in the Location header.
+        """
 
         self.response.content_type = "application/json"
 
-        if self._content is None:
+        content_type = self.request.headers.get("X-Upload-Content-Type", "").split(";")[0].strip().lower()
+        if not _is_media(content_type):
             self.response.status = 400
-            self.response.out.write(utils.createError(400, "Couldn't decode content or invalid content-type"))
+            self.response.out.write(utils.createError(400, "Invalid or missing X-Upload-Content-Type"))
+            return
 
-        # 1) Insert new card using
-        if self._metainfo is None:
-            request = self._service.internal().timeline().insert(body={})
-        else:
-            request = self._service.internal().timeline().insert(body=self._metainfo)
+        content_length = self.request.headers.get("X-Upload-Content-Length")
+        if content_length is not None:
+            if not content_length.isdigit():
+                self.response.status = 400
+                self.response.out.write(utils.createError(400, "Invalid X-Upload-Content-Length"))
+                return
+            content_length = int(content_length)
+
+        metainfo = None
+        if len(self.request.body) > 0:
+            try:
+                metainfo = json.loads(self.request.body)
+            except ValueError:
+                metainfo = None
+            if not isinstance(metainfo, dict):
+                self.response.status = 400
+                self.response.out.write(utils.createError(400, "Couldn't decode metainfo"))
+                return
+
+        file_name = str(uuid.uuid4())
+        writer = gcs.open(bucket + "/" + file_name,
+                          'w',
+                          content_type=content_type,
+                          retry_params=gcs.RetryParams(backoff_factor=1.1))
+
+        session = UploadSession(id=uuid.uuid4().hex,
+                                owner=self._scope,
+                                objectName=file_name,
+                                contentType=content_type,
+                                contentLength=content_length,
+                                metainfo=metainfo,
+                                writer=writer)
+        session.put()
+
+        self.response.status = 200
+        self.response.headers["Location"] = "%s?uploadType=resumable&upload_id=%s" % (self.request.path_url, session.key.id())
+
+    def _resume_upload(self, upload_id):
+        """Receive the next chunk of a resumable upload or report its status
+
+        Content-Range is either "bytes first-last/total" for a chunk of
+        content, or "bytes */total" to query how much has been received.
+        The total may be "*" until the last chunk. Incomplete uploads are
+        answered with 308 and a Range header of the received bytes.
+        Chunks have to match their Content-Range and can't go beyond the
+        total length. Requests for the same session are handled one at a time.
+        """
+
+        # The pickled writer can only be used by one request at a time
+        lock = "upload:%s" % upload_id
+        if not memcache.add(lock, 1, time=_SESSION_LOCK_TIME):
+            self._error(409, "Another request for this upload session is in progress.")
+            return
 
         try:
-            card = request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
+            self._resume_locked_upload(upload_id)
+        finally:
+            memcache.delete(lock)
+
+    def _resume_locked_upload(self, upload_id):
+        session = ndb.Key(UploadSession, upload_id).get()
+        if session is None or session.owner != self._scope:
+            self._error(404, "Upload session not found.")
             return
 
-        # 2) Insert data into cloud storage
-        write_retry_params = gcs.RetryParams(backoff_factor=1.1)
-        file_name = str(uuid.uuid4())
-        gcs_file = gcs.open(bucket + "/" + file_name,
-                        'w',
-                        content_type=self._content_type,
-                        retry_params=write_retry_params)
-        gcs_file.write(self._content)
-        gcs_file.close()
+        if session.complete:
+            self._write_session_result(session)
+            return
+
+        content_range = _CONTENT_RANGE.match(self.request.headers.get("Content-Range", "bytes */*"))
+        if content_range is None:
+            self._error(400, "Invalid Content-Range")
+            return
 
-        # 3) Update card with attachment info
-        if not "attachments" in card:
-            card["attachments"] = []
+        first, last, total = content_range.groups()
+        if total != "*":
+            total = int(total)
+            if session.contentLength is not None and total != session.contentLength:
+                self._error(400, "Content-Range doesn't match the length of the upload.")
+                return
+            if total < session.received:
+                self._error(400, "Content-Range is shorter than the content already received.")
+                return
+            session.contentLength = total
 
-        attachment = {
-            "id": file_name,
-            "contentType": self._content_type,
-            "contentUrl": "%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, card["id"], file_name),
-            "isProcessing": False
-        }
+        if first is not None:
+            first = int(first)
+            last = int(last)
+            if last < first or self.request.content_length != last - first + 1:
+                self._error(400, "Length of the body doesn't match Content-Range.")
+                return
+            if session.contentLength is not None and last >= session.contentLength:
+                self._error(400, "Content-Range exceeds the length of the upload.")
+                return
 
-        card["attachments"].append(attachment)
+        if first is not None and first <= session.received:
+            # Skip bytes that have already been received in an earlier request
+            skip = session.received - first
+            for chunk in _read_chunks(self.request.body_file):
+                if skip >= len(chunk):
+                    skip -= len(chunk)
+                    continue
+                chunk = chunk[skip:]
+                skip = 0
+                session.writer.write(chunk)
+                session.received += len(chunk)
+
+            # Only data aligned to cloud storage blocks is kept in the session
+            session.writer.flush()
+
+        if session.contentLength is None or session.received < session.contentLength:
+            session.put()
+            self.response.status = "308 Resume Incomplete"
+            if session.received > 0:
+                self.response.headers["Range"] = "bytes=0-%s" % (session.received - 1)
+            return
 
-        request = self._service.internal().timeline().update(id=card["id"], body=card)
+        session.writer.close()
+        session.writer = None
+        session.complete = True
 
+        self._uploads.append((attachments.adopt(session.objectName, session.contentType), session.contentType))
+        self._metainfo = session.metainfo
         try:
-            result = request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
+            self._upload(*self.request.route_args)
+        except:
+            self._discard_attachments()
+            raise
+
+        session.resultStatus = self.response.status_int
+        session.result = self.response.body
+        session.put()
+
+    def _write_session_result(self, session):
+        self.response.content_type = "application/json"
+        self.response.status = session.resultStatus
+        self.response.out.write(session.result)
+
+    def _checkauth(self):
+        """Validate the access token of the request once and remember its user"""
+
+        self._user = tokens.get_current_user(self.request.headers.get("Authorization"))
+
+    def _error(self, code, message):
+        self.response.content_type = "application/json"
+        self.response.status = code
+        self.response.out.write(utils.createError(code, message))
+
+    def _get_card(self, id):
+        """Retrieve a card of the current user, None if it doesn't exist or has been deleted"""
+
+        if not id.isdigit():
+            return None
+
+        card = ndb.Key(TimelineItem, int(id)).get()
+        if card is None or card.user != self._user or card.isDeleted:
+            return None
+
+        return card
+
+    def _insert_card(self, card):
+        """Store a new card with all uploaded content as attachments and write the response
+
+        Content that hasn't been processed yet is queued for processing
+        in the same transaction.
+        """
+
+        self._processing = processing.needs_processing(self._uploads)
+        card.attachments = _new_attachments(card.key.integer_id(), self._uploads, self._processing)
+
+        _put_card(card, self._processing)
+        self._write_card(card)
+
+    def _attach_to_card(self, card, fields=None):
+        """Add all uploaded content to a stored card, with the values of fields, and write the response"""
+
+        self._processing = processing.needs_processing(self._uploads)
+
+        card = _update_card(card.key.integer_id(), self._user, self._uploads, self._processing, fields)
+        if card is None:
+            self._discard_attachments()
+            self._error(404, "Card not found.")
             return
 
-        self.response.status = 200
-        self.response.out.write(json.dumps(result))
+        self._write_card(card)
 
+    def _write_card(self, card):
+        """Return the stored card with the same JSON representation as the API"""
 
-class UpdateHandler(UploadHandler):
+        # The card holds the references now, they must not be discarded anymore
+        self._uploads = []
 
-    def put(self, id):
+        channel.send_message(card.user.email(), json.dumps({"id": card.id}))
 
         self.response.content_type = "application/json"
+        self.response.status = 200
+        self.response.out.write(_PROTOJSON.encode_message(card.ToMessage()))
 
-        if self._content is None:
-            self.response.status = 400
-            self.response.out.write(utils.createError(400, "Couldn't decode content or invalid content-type"))
+    def _decode(self):
+        """Check for valid content types and stream all media content to cloud storage
+
+        Raises:
+            multipart.MultipartError: if a multipart body or its metainfo can't be parsed
+        """
+
+        content_type = self.request.content_type
+        if content_type == "multipart/related" or content_type == "multipart/mixed":
+            boundary = multipart.get_boundary(self.request.headers["Content-Type"])
+            if boundary is None:
+                return
+
+            for part in multipart.MultipartReader(self.request.body_file, boundary):
+                content_type = part.content_type
+                if _is_media(content_type):
+                    attachment_id = _store_attachment(part.chunks(), content_type,
+                                                      part.transfer_encoding == "base64")
+                    self._uploads.append((attachment_id, content_type))
+                elif content_type == "application/json":
+                    if self._metainfo is None:
+                        try:
+                            self._metainfo = json.loads(part.read())
+                        except ValueError:
+                            raise multipart.MultipartError("Couldn't decode metainfo.")
 
-        # Trying to access card to see if user is allowed to
-        request = self._service.timeline().get(id=id)
-        try:
-            card = request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
             return
 
-        # 2) Insert data into cloud storage
-        write_retry_params = gcs.RetryParams(backoff_factor=1.1)
-        file_name = str(uuid.uuid4())
-        gcs_file = gcs.open(bucket + "/" + file_name,
-                        'w',
-                        content_type=self._content_type,
-                        retry_params=write_retry_params)
-        gcs_file.write(self._content)
-        gcs_file.close()
-
-        # 3) Update card with attachment info and new metainfo
-        if self._metainfo is None:
-            new_card = {}
-        else:
-            new_card = self._metainfo
-
-        if "attachments" in card:
-            new_card["attachments"] = card["attachments"]
-        else:
-            new_card["attachments"] = []
-
-        attachment = {
-            "id": file_name,
-            "contentType": self._content_type,
-            "contentUrl": "%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, card["id"], file_name),
-            "isProcessing": False
-        }
-
-        new_card["attachments"].append(attachment)
-
-        request = self._service.internal().timeline().update(id=card["id"], body=new_card)
+        if _is_media(content_type):
+            base64 = ("Content-Transfer-Encoding" in self.request.headers and
+                      self.request.headers["Content-Transfer-Encoding"].lower() == "base64")
+            attachment_id = _store_attachment(_read_chunks(self.request.body_file), content_type, base64)
+            self._uploads.append((attachment_id, content_type))
+
+    def _discard_attachments(self):
+        """Remove stored media content if it can't be attached to a card"""
+
+        uploads, self._uploads = self._uploads, []
+        for attachment_id, content_type in uploads:
+            attachments.release(attachment_id)
+
+
+class InsertHandler(UploadHandler):
+
+    _idempotent = True
+    _resumable = True
+
+    def post(self):
+        self._upload()
+
+    def _upload(self):
+
+        if not self._uploads:
+            self._error(400, "Couldn't decode content or invalid content-type")
+            return
 
         try:
-            result = request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
+            card = _card_from_metainfo(self._metainfo)
+            cards.validate_menu_items(card)
+        except endpoints.ServiceException as e:
+            self._discard_attachments()
+            self._error(e.http_status, str(e))
+            return
+        except (ValueError, messages.Error) as e:
+            self._discard_attachments()
+            self._error(400, "Invalid metainfo. %s" % e)
             return
 
-        self.response.status = 200
-        self.response.out.write(json.dumps(result))
+        # Allocate the ID first, since it is part of the attachment URL
+        card.key = ndb.Key(TimelineItem, TimelineItem.allocate_ids(1)[0])
+        card.user = self._user
+        card.isDeleted = False
 
+        self._insert_card(card)
 
-class AttachmentInsertHandler(UploadHandler):
 
-    def post(self, id):
+class UpdateHandler(UploadHandler):
 
-        self.response.content_type = "application/json"
+    _resumable = True
 
-        if self._content is None:
-            self.response.status = 400
-            self.response.out.write(utils.createError(400, "Couldn't decode content or invalid content-type"))
+    def put(self, id):
+        self._upload(id)
+
+    def _upload(self, id):
+
+        if not self._uploads:
+            self._error(400, "Couldn't decode content or invalid content-type")
+            return
+
+        card = self._get_card(id)
+        if card is None:
+            self._discard_attachments()
+            self._error(404, "Card not found.")
+            return
 
-        # Trying to access card to see if user is allowed to
-        request = self._service.timeline().get(id=id)
         try:
-            card = request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
+            new_card = _card_from_metainfo(self._metainfo)
+            cards.validate_menu_items(new_card)
+        except endpoints.ServiceException as e:
+            self._discard_attachments()
+            self._error(e.http_status, str(e))
+            return
+        except (ValueError, messages.Error) as e:
+            self._discard_attachments()
+            self._error(400, "Invalid metainfo. %s" % e)
             return
 
-        # 2) Insert data into cloud storage
-        write_retry_params = gcs.RetryParams(backoff_factor=1.1)
-        file_name = str(uuid.uuid4())
-        gcs_file = gcs.open(bucket + "/" + file_name,
-                        'w',
-                        content_type=self._content_type,
-                        retry_params=write_retry_params)
-        gcs_file.write(self._content)
-        gcs_file.close()
+        self._attach_to_card(card, new_card)
 
-        # 3) Update card with attachment info
-        if not "attachments" in card:
-            card["attachments"] = []
 
-        attachment = {
-            "id": file_name,
-            "contentType": self._content_type,
-            "contentUrl": "%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, card["id"], file_name),
-            "isProcessing": False
-        }
+class AttachmentInsertHandler(UploadHandler):
 
-        card["attachments"].append(attachment)
+    _idempotent = True
 
-        request = self._service.internal().timeline().update(id=card["id"], body=card)
+    def post(self, id):
+        self._upload(id)
 
-        try:
-            result = request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
+    def _upload(self, id):
+
+        if not self._uploads:
+            self._error(400, "Couldn't decode content or invalid content-type")
             return
 
-        self.response.status = 200
-        self.response.out.write(json.dumps(result))
+        card = self._get_card(id)
+        if card is None:
+            self._discard_attachments()
+            self._error(404, "Card not found.")
+            return
+
+        self._attach_to_card(card)
 
 
 class DownloadHandler(UploadHandler, blobstore_handlers.BlobstoreDownloadHandler):
+    """Serve attachment content with support for byte ranges and conditional requests
+
+    The content of an attachment never changes, its ID is used as strong ETag.
+    Images can be requested in a smaller size with ?size=display or ?size=thumbnail.
+    Until that rendition exists the original is served with the size in its
+    ETag, and without letting clients cache it.
+    """
 
     def get(self, id, attachment):
 
-        # Trying to access card to see if user is allowed to
-        request = self._service.timeline().get(id=id)
+        card = self._get_card(id)
+        if card is None or attachment not in [att.id for att in card.attachments]:
+            self._error(404, "Attachment not found.")
+            return
+
+        etag = '"%s"' % attachment
+        cache_control = _CACHE_CONTROL
+        original = attachment
+
+        size = self.request.GET.get("size")
+        if size is not None:
+            if size not in renditions.SIZES:
+                self._error(400, "Invalid size.")
+                return
+            rendition = renditions.get_rendition(attachment, size)
+            if rendition == attachment:
+                # The original, which is different from what a cached rendition would be
+                etag = '"%s-%s"' % (attachment, size)
+                if not attachments.is_processed(attachment):
+                    # Clients have to come back for the rendition once it has been created
+                    cache_control = _PENDING_CACHE_CONTROL
+            else:
+                etag = '"%s"' % rendition
+            attachment = rendition
+
         try:
-            request.execute()
-        except HttpError as e:
-            self.response.status = e.resp.status
-            self.response.out.write(e.content)
+            path, created = attachments.object_info(attachment)
+        except gcs.NotFoundError:
+            if attachment == original:
+                self._error(404, "Attachment not found.")
+                return
+            # The rendition is gone, e.g. removed by the sweeper, serve the original instead
+            logging.warning("Rendition %s of attachment %s not found" % (attachment, original))
+            etag = '"%s-%s"' % (original, size)
+            cache_control = _PENDING_CACHE_CONTROL
+            try:
+                path, created = attachments.object_info(original)
+            except gcs.NotFoundError:
+                self._error(404, "Attachment not found.")
+                return
+
+        last_modified = _http_date(created)
+
+        self.response.headers["ETag"] = etag
+        self.response.headers["Last-Modified"] = last_modified
+        self.response.headers["Cache-Control"] = cache_control
+        self.response.headers["Accept-Ranges"] = "bytes"
+
+        if not self._is_modified(etag, created):
+            self.response.status = 304
             return
 
-        blob_key = blobstore.create_gs_key("/gs" + bucket + "/" + attachment)
-        self.send_blob(blob_key)
+        # Ranges only apply if the client still has the same version
+        if_range = self.request.headers.get("If-Range")
+        use_range = if_range is None or if_range in (etag, last_modified)
+
+        blob_key = blobstore.create_gs_key("/gs" + path)
+        self.send_blob(blob_key, use_range=use_range)
+
+    def _is_modified(self, etag, created):
+        """Evaluate If-None-Match, or If-Modified-Since if no ETags were sent"""
+
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            # Weak comparison as required for If-None-Match
+            tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+            return "*" not in tags and etag not in tags
+
+        if_modified_since = self.request.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None:
+                return calendar.timegm(created.utctimetuple()) > email.utils.mktime_tz(since)
+
+        return True
 
 
 app = webapp2.WSGIApplication(
@@ -22,74 +22,224 @@ for the demo services. Sets up Contacts and Subscriptions when the user
 first connects. Also handles disconnection by removing all contacts and
 subscriptions and deleting credentials when the user wants to disconnect.
 
+RefreshTokensHandler runs as a cron job and refreshes access tokens before
+they expire, so requests and notifications don't have to wait for it.
+
 """
 
 __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 
+import dispatch
 import utils
 from demos import demo_services
 
-import random
-import string
+import datetime
 import httplib2
 import json
 import logging
+import threading
+import time
+import webapp2
 
-from apiclient.discovery import build
 from apiclient.errors import HttpError
 from apiclient.errors import UnknownApiNameOrVersion
+from apiclient.http import BatchHttpRequest
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 from oauth2client.client import AccessTokenRefreshError
-from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
 from oauth2client.appengine import StorageByKeyName
 
+# Pooled API clients are rebuilt after this many seconds, so credentials
+# changed by other instances are picked up eventually
+_SERVICE_TTL = 10 * 60
+
+# Maximum number of requests in one batch
+_BATCH_SIZE = 50
+
+# Access tokens expiring within this time are refreshed by RefreshTokensHandler,
+# which should run more often than that (see cron.yaml)
+_REFRESH_AHEAD = datetime.timedelta(minutes=15)
+
+# Tokens that expired longer ago belong to inactive users and are refreshed on their next request
+_REFRESH_MAX_AGE = datetime.timedelta(days=1)
+
+# Number of users whose tokens are refreshed at the same time
+_REFRESH_BATCH_SIZE = 20
+
+# Seconds one refresh may hold the lock of a user
+_REFRESH_LOCK_TIME = 60
+
+# Seconds a request waits for a refresh of the same user running elsewhere
+_REFRESH_WAIT = 10
+
+# httplib2.Http isn't thread-safe, so each thread keeps its own pool
+_pool = threading.local()
+
+# Incremented when credentials of a user change, invalidates pooled clients in all threads
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+def _user_model(test):
+    return utils.TestUser if test is not None else utils.User
+
+
+@ndb.transactional
+def update_user(gplus_id, test, **values):
+    """
+    Set properties of a stored user, returns the user or None if it doesn't exist
+
+    The user is read again in a transaction, so concurrent writes of other
+    properties, like refreshed credentials, aren't overwritten.
+    """
+
+    user = _user_model(test).get_by_id(gplus_id)
+    if user is None:
+        return None
+
+    for name, value in values.items():
+        setattr(user, name, value)
+    user.put()
+
+    return user
+
+
+class _CredentialsStorage(StorageByKeyName):
+    """Writes credentials in a transaction, so other properties of the user aren't overwritten"""
+
+    def locked_put(self, credentials):
+        _put_credentials(self._model, self._key_name, credentials)
+
+
+@ndb.transactional
+def _put_credentials(model, gplus_id, credentials):
+    user = model.get_by_id(gplus_id)
+    if user is None:
+        user = model(id=gplus_id)
+    user.credentials = credentials
+    user.put()
+
 
 def get_credentials(gplus_id, test):
     """Retrieves credentials for the provided Google+ User ID from the Datastore"""
-    if test is not None:
-        storage = StorageByKeyName(utils.TestUser, gplus_id, "credentials")
-    else:
-        storage = StorageByKeyName(utils.User, gplus_id, "credentials")
+    storage = _CredentialsStorage(_user_model(test), gplus_id, "credentials")
     credentials = storage.get()
     return credentials
 
 
 def store_credentials(gplus_id, test, credentials):
     """Stores credentials for the provide Google+ User ID to Datastore"""
-    if test is not None:
-        storage = StorageByKeyName(utils.TestUser, gplus_id, "credentials")
-    else:
-        storage = StorageByKeyName(utils.User, gplus_id, "credentials")
+    storage = _CredentialsStorage(_user_model(test), gplus_id, "credentials")
     storage.put(credentials)
+    _invalidate_services(gplus_id, test)
 
 
-def get_auth_service(gplus_id, test, api="mirror", version="v1"):
-    """Creates a new authenticated API client using the stored credentials"""
+def _invalidate_services(gplus_id, test):
+    """Make all threads of this instance drop their pooled API clients for the user"""
 
-    if test is not None and api == "mirror" and version == "v1":
-        # Use internal API for mirror API in test mode
-        discovery_service_url = utils.discovery_service_url
-    else:
-        # Use Google APIs in all other cases
-        discovery_service_url = None
+    with _generations_lock:
+        key = (gplus_id, test)
+        _generations[key] = _generations.get(key, 0) + 1
+
+
+def _get_pool_entry(gplus_id, test):
+    """Pooled authorized http object and API clients for the user, None without credentials"""
+
+    pool = getattr(_pool, "users", None)
+    if pool is None:
+        pool = _pool.users = {}
+
+    now = time.time()
+    generation = _generations.get((gplus_id, test), 0)
+    entry = pool.get((gplus_id, test))
+    if (entry is not None and entry["generation"] == generation and entry["expires"] > now and
+            not entry["credentials"].access_token_expired):
+        return entry
+
+    # Drop expired entries of other users while we are at it
+    for key in [key for key, value in pool.items() if value["expires"] <= now]:
+        del pool[key]
+    pool.pop((gplus_id, test), None)
 
     credentials = get_credentials(gplus_id, test)
     if credentials is None:
         return None
 
+    if credentials.access_token_expired and credentials.refresh_token is not None:
+        # Refresh under the same lock as RefreshTokensHandler, not on the first request
+        credentials = _refresh_credentials(gplus_id, test, datetime.datetime.utcnow(), wait=True)
+        if credentials is None:
+            return None
+
     http = httplib2.Http()
     http = credentials.authorize(http)
     http.timeout = 60
 
-    if discovery_service_url is None:
-        service = build(api, version, http=http)
+    entry = {"http": http, "credentials": credentials, "services": {},
+             "generation": generation, "expires": now + _SERVICE_TTL}
+    pool[(gplus_id, test)] = entry
+
+    return entry
+
+
+def get_auth_service(gplus_id, test, api="mirror", version="v1"):
+    """Returns an authenticated API client using the stored credentials
+
+    Clients are pooled per thread and reused for _SERVICE_TTL seconds or
+    until new credentials are stored for the user.
+    """
+
+    if test is not None and api == "mirror" and version == "v1":
+        # Use internal API for mirror API in test mode
+        discovery_service_url = utils.discovery_service_url
     else:
-        service = build(api, version, http=http, discoveryServiceUrl=discovery_service_url)
+        # Use Google APIs in all other cases
+        discovery_service_url = None
+
+    entry = _get_pool_entry(gplus_id, test)
+    if entry is None:
+        return None
+
+    service = entry["services"].get((api, version))
+    if service is None:
+        service = utils.build_service(api, version, entry["http"], discovery_service_url)
+        entry["services"][(api, version)] = service
 
     return service
 
 
+def execute_batch(requests, test):
+    """Execute API requests, returns their responses in the same order
+
+    Requests are sent in batches of _BATCH_SIZE, which Google runs in parallel.
+    The internal Mirror API doesn't support batches, so in test mode they run
+    one after another. Raises the first error of any request.
+    """
+
+    if test is not None:
+        return [request.execute() for request in requests]
+
+    responses = [None] * len(requests)
+    errors = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errors.append(exception)
+        else:
+            responses[int(request_id)] = response
+
+    for offset in range(0, len(requests), _BATCH_SIZE):
+        batch = BatchHttpRequest(callback=callback)
+        for index in range(offset, min(offset + _BATCH_SIZE, len(requests))):
+            batch.add(requests[index], request_id=str(index))
+        batch.execute()
+        if errors:
+            raise errors[0]
+
+    return responses
+
+
 def _disconnect(gplus_id, test):
     """Delete credentials in case of errors"""
 
@@ -116,10 +266,9 @@ class ConnectHandler(utils.BaseHandler):
             self.response.out.write(utils.createError(401, "Invalid state parameter"))
             return
 
+        # Exchange the code and check the access token, verified locally if possible
         try:
-            oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-            oauth_flow.redirect_uri = 'postmessage'
-            credentials = oauth_flow.step2_exchange(code)
+            credentials, result = utils.exchange_code(code)
         except FlowExchangeError:
             self.response.status = 401
             self.response.out.write(
@@ -127,12 +276,6 @@ class ConnectHandler(utils.BaseHandler):
             )
             return
 
-        # Check that the access token is valid.
-        access_token = credentials.access_token
-        url = ("https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s" % access_token)
-        h = httplib2.Http()
-        result = json.loads(h.request(url, 'GET')[1])
-
         # If there was an error in the access token info, abort.
         if result.get("error") is not None:
             self.response.status = 500
@@ -192,9 +335,14 @@ class ConnectHandler(utils.BaseHandler):
             self.response.out.write(utils.createError(500, "Failed to initialize client library. %s" % e))
             return
 
-        # Fetch user information
+        # Fetch user information and what has been registered before
         try:
-            result = plus_service.people().get(userId="me", fields="displayName,image").execute()
+            profile, friends, old_contacts, old_subscriptions = execute_batch([
+                plus_service.people().get(userId="me", fields="displayName,image"),
+                plus_service.people().list(userId="me", collection="visible", maxResults=100, orderBy="best", fields="items/id"),
+                service.contacts().list(),
+                service.subscriptions().list()
+            ], test)
         except AccessTokenRefreshError:
             _disconnect(gplus_id, test)
             self.response.status = 401
@@ -205,125 +353,58 @@ class ConnectHandler(utils.BaseHandler):
             self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
             return
 
-        # Store some public user information for later user
-        if test is not None:
-            user = ndb.Key("TestUser", gplus_id).get()
-        else:
-            user = ndb.Key("User", gplus_id).get()
-        user.displayName = result["displayName"]
-        user.imageUrl = result["image"]["url"]
-        user.put()
+        # Store some public user information and friends for later use
+        # Random verifyTokens from earlier connections aren't valid anymore
+        update_user(gplus_id, test,
+                    displayName=profile["displayName"],
+                    imageUrl=profile["image"]["url"],
+                    friends=[item["id"] for item in friends.get("items", [])],
+                    verifyToken=None)
 
-        # Fetch user friends and store for later user
-        try:
-            result = plus_service.people().list(userId="me", collection="visible", maxResults=100, orderBy="best", fields="items/id").execute()
-        except AccessTokenRefreshError:
-            _disconnect(gplus_id, test)
-            self.response.status = 401
-            self.response.out.write(utils.createError(401, "Failed to refresh access token."))
-            return
-        except HttpError as e:
-            self.response.status = 500
-            self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-            return
-
-        friends = []
-        if "items" in result:
-            for item in result["items"]:
-                friends.append(item["id"])
+        """
+        Re-register contacts and subscriptions to make sure all of them are available.
+        Existing ones are deleted, so only the currently implemented contacts are available.
+        For the purposes of this demo service all possible subscriptions are made.
+        Normally you would only set-up subscriptions for the services you need.
+        """
 
-        user.friends = friends
-        user.put()
+        deletes = []
+        for contact in old_contacts.get("items", []):
+            deletes.append(service.contacts().delete(id=contact["id"]))
+        for subscription in old_subscriptions.get("items", []):
+            deletes.append(service.subscriptions().delete(id=subscription["id"]))
 
-        # Delete all existing contacts, so only the currently implemented ones are available
-        try:
-            result = service.contacts().list().execute()
-            if "items" in result:
-                for contact in result["items"]:
-                    del_result = service.contacts().delete(id=contact["id"]).execute()
-        except AccessTokenRefreshError:
-            _disconnect(gplus_id, test)
-            self.response.status = 401
-            self.response.out.write(utils.createError(401, "Failed to refresh access token."))
-            return
-        except HttpError as e:
-            self.response.status = 500
-            self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-            return
+        inserts = []
 
         # Register contacts defined in the demo services
-        contacts = []
         for demo_service in demo_services:
             if hasattr(demo_service, "CONTACTS"):
-                contacts.extend(demo_service.CONTACTS)
-
-        for contact in contacts:
-            try:
-                result = service.contacts().insert(body=contact).execute()
-            except AccessTokenRefreshError:
-                _disconnect(gplus_id, test)
-                self.response.status = 401
-                self.response.out.write(utils.createError(401, "Failed to refresh access token."))
-                return
-            except HttpError as e:
-                self.response.status = 500
-                self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-                return
+                for contact in demo_service.CONTACTS:
+                    inserts.append(service.contacts().insert(body=contact))
 
-        """
-        Re-register subscriptions to make sure all of them are available.
-        Normally it would be best to use subscriptions.list first to check.
-        For the purposes of this demo service all possible subscriptions are made.
-        Normally you would only set-up subscriptions for the services you need.
-        """
+        # verifyToken is derived from the user ID, so notifications can be checked without datastore access
+        verifyToken = utils.create_verify_token(gplus_id, test)
 
-        # Delete all existing subscriptions
-        try:
-            result = service.subscriptions().list().execute()
-            if "items" in result:
-                for subscription in result["items"]:
-                    del_result = service.subscriptions().delete(id=subscription["id"]).execute()
-        except AccessTokenRefreshError:
-            _disconnect(gplus_id, test)
-            self.response.status = 401
-            self.response.out.write(utils.createError(401, "Failed to refresh access token."))
-            return
-        except HttpError as e:
-            self.response.status = 500
-            self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-            return
+        # Subscribe to all timeline inserts/updates/deletes and all location updates
+        for collection, callback in [("timeline", "/timeline_update"), ("locations", "/locations_update")]:
+            body = {}
+            body["collection"] = collection
+            body["userToken"] = gplus_id
+            body["verifyToken"] = verifyToken
+            body["callbackUrl"] = utils.base_url + ("" if test is None else "/test") + callback
+            inserts.append(service.subscriptions().insert(body=body))
 
-        # Generate random verifyToken and store it in User entity
-        verifyToken = ''.join(random.choice(string.ascii_letters + string.digits) for x in range(32))
-        user.verifyToken = verifyToken
-        user.put()
-
-        # Subscribe to all timeline inserts/updates/deletes
-        body = {}
-        body["collection"] = "timeline"
-        body["userToken"] = gplus_id
-        body["verifyToken"] = verifyToken
-        body["callbackUrl"] = utils.base_url + ("" if test is None else "/test") + "/timeline_update"
-        try:
-            result = service.subscriptions().insert(body=body).execute()
-        except AccessTokenRefreshError:
-            _disconnect(gplus_id, test)
-            self.response.status = 401
-            self.response.out.write(utils.createError(401, "Failed to refresh access token."))
-            return
-        except HttpError as e:
-            self.response.status = 500
-            self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-            return
+        # Send welcome messages for new users
+        if new_user:
+            for demo_service in demo_services:
+                if hasattr(demo_service, "WELCOMES"):
+                    for welcome in demo_service.WELCOMES:
+                        inserts.append(service.timeline().insert(body=welcome))
 
-        # Subscribe to all location updates
-        body = {}
-        body["collection"] = "locations"
-        body["userToken"] = gplus_id
-        body["verifyToken"] = verifyToken
-        body["callbackUrl"] = utils.base_url + ("" if test is None else "/test") + "/locations_update"
+        # Deletes have to finish first, demo contacts keep their ids
         try:
-            result = service.subscriptions().insert(body=body).execute()
+            execute_batch(deletes, test)
+            execute_batch(inserts, test)
         except AccessTokenRefreshError:
             _disconnect(gplus_id, test)
             self.response.status = 401
@@ -339,25 +420,6 @@ class ConnectHandler(utils.BaseHandler):
             self.response.out.write(utils.createMessage("Current user is already connected."))
             return
 
-        # Send welcome messages for new users
-        welcomes = []
-        for demo_service in demo_services:
-            if hasattr(demo_service, "WELCOMES"):
-                welcomes.extend(demo_service.WELCOMES)
-
-        for welcome in welcomes:
-            try:
-                result = service.timeline().insert(body=welcome).execute()
-            except AccessTokenRefreshError:
-                _disconnect(gplus_id, test)
-                self.response.status = 401
-                self.response.out.write(utils.createError(401, "Failed to refresh access token."))
-                return
-            except HttpError as e:
-                self.response.status = 500
-                self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-                return
-
         self.response.status = 200
         self.response.out.write(utils.createMessage("Successfully connected user."))
 
@@ -397,27 +459,19 @@ class DisconnectHandler(utils.BaseHandler):
             self.response.out.write(utils.createError(500, "Failed to initialize client library. %s" % e))
             return
 
-        # De-register contacts
-        try:
-            result = service.contacts().list().execute()
-            if "items" in result:
-                for contact in result["items"]:
-                    del_result = service.contacts().delete(id=contact["id"]).execute()
-        except AccessTokenRefreshError:
-            self.response.status = 500
-            self.response.out.write(utils.createError(500, "Failed to refresh access token."))
-            return
-        except HttpError as e:
-            self.response.status = 500
-            self.response.out.write(utils.createError(500, "Failed to execute request. %s" % e))
-            return
-
-        # De-register subscriptions
+        # De-register contacts and subscriptions
         try:
-            result = service.subscriptions().list().execute()
-            if "items" in result:
-                for subscription in result["items"]:
-                    del_result = service.subscriptions().delete(id=subscription["id"]).execute()
+            contacts, subscriptions = execute_batch([
+                service.contacts().list(),
+                service.subscriptions().list()
+            ], test)
+
+            deletes = []
+            for contact in contacts.get("items", []):
+                deletes.append(service.contacts().delete(id=contact["id"]))
+            for subscription in subscriptions.get("items", []):
+                deletes.append(service.subscriptions().delete(id=subscription["id"]))
+            execute_batch(deletes, test)
         except AccessTokenRefreshError:
             self.response.status = 500
             self.response.out.write(utils.createError(500, "Failed to refresh access token."))
@@ -451,9 +505,70 @@ class DisconnectHandler(utils.BaseHandler):
             ndb.Key("TestUser", gplus_id).delete()
         else:
             ndb.Key("User", gplus_id).delete()
+        _invalidate_services(gplus_id, test)
+
+
+def _refresh_credentials(gplus_id, test, cutoff, wait=False):
+    """
+    Refresh the access token of a user unless it is valid beyond cutoff
+
+    Only one refresh per user runs at a time. If another one is running the
+    user is skipped, or with wait the other refresh is given _REFRESH_WAIT
+    seconds to finish. Returns the stored credentials afterwards, which
+    are still expired if the refresh failed, so requests made with them
+    report the AccessTokenRefreshError as before.
+    """
+
+    lock = "%s:%s" % ("test" if test is not None else "", gplus_id)
+    deadline = time.time() + _REFRESH_WAIT
+    while not memcache.add(lock, 1, time=_REFRESH_LOCK_TIME, namespace="refresh"):
+        if not wait or time.time() > deadline:
+            logging.info("Refresh of %s already running", gplus_id)
+            return get_credentials(gplus_id, test)
+        time.sleep(0.5)
+
+    try:
+        # Stored credentials might have been refreshed since the query, or by the refresh we waited for
+        credentials = get_credentials(gplus_id, test)
+        if credentials is None or credentials.refresh_token is None:
+            return credentials
+        if credentials.token_expiry is not None and credentials.token_expiry > cutoff:
+            return credentials
+
+        # Writes the new token back to the datastore, other instances pick it up from there
+        credentials.refresh(httplib2.Http())
+        return credentials
+    except AccessTokenRefreshError:
+        logging.warning("Failed to refresh access token of %s", gplus_id)
+        return credentials
+    finally:
+        memcache.delete(lock, namespace="refresh")
+
+
+class RefreshTokensHandler(webapp2.RequestHandler):
+    """Refreshes access tokens that are about to expire, restricted to admins in app.yaml"""
+
+    def get(self):
+        now = datetime.datetime.utcnow()
+        cutoff = now + _REFRESH_AHEAD
+
+        for model, test in [(utils.User, None), (utils.TestUser, "test")]:
+            query = model.query(model.tokenExpiry > now - _REFRESH_MAX_AGE,
+                                model.tokenExpiry < cutoff)
+            cursor = None
+            more = True
+            while more:
+                keys, cursor, more = query.fetch_page(_REFRESH_BATCH_SIZE, start_cursor=cursor,
+                                                      keys_only=True)
+                dispatch.run([
+                    dispatch.Job("Refresh %s" % key.id(),
+                                 lambda gplus_id=key.id(), test=test: _refresh_credentials(gplus_id, test, cutoff))
+                    for key in keys
+                ], max_threads=_REFRESH_BATCH_SIZE)
 
 
 AUTH_ROUTES = [
     (r"(/test)?/connect", ConnectHandler),
-    (r"(/test)?/disconnect", DisconnectHandler)
+    (r"(/test)?/disconnect", DisconnectHandler),
+    ("/cron/refresh_tokens", RefreshTokensHandler)
 ]
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs the callbacks of demo services concurrently
+
+A notification can be handled by several demo services, which run on a
+bounded number of threads so a slow demo service doesn't delay the others.
+Each callback has a time budget, a callback that exceeds it is abandoned
+and its thread replaced, so the remaining callbacks can still run.
+Threads can't be stopped, so an abandoned callback keeps running in the
+background until it returns. Its HTTP requests use the budget as
+deadline, so no single request can keep it going for longer than that.
+
+Exceptions are logged and don't affect the other callbacks. run returns
+the jobs that failed or were abandoned, so callers can have them retried.
+"""
+
+__author__ = 'scarygami@gmail.com (Gerwin Sturm)'
+
+import logging
+import threading
+import time
+
+from google.appengine.api import urlfetch
+
+MAX_THREADS = 4
+
+# Seconds a callback may take, demo services can change it with "budget" in HANDLES
+DEFAULT_BUDGET = 30
+
+
+class Job(object):
+    """A callback to run, name is used for logging"""
+
+    def __init__(self, name, function, budget=DEFAULT_BUDGET):
+        self.name = name
+        self.function = function
+        self.budget = budget
+        self.started = None
+        self.finished = False
+        self.error = None
+
+
+class DispatchError(Exception):
+    """Raised by callers of run for the jobs that failed or were abandoned"""
+
+    def __init__(self, failed):
+        Exception.__init__(self, "%s of the callbacks failed: %s" %
+                           (len(failed), ", ".join(job.name for job in failed)))
+        self.failed = failed
+
+
+def run(jobs, max_threads=MAX_THREADS):
+    """
+    Run all jobs on at most max_threads threads
+
+    Returns when every job has finished or exceeded its budget, with the
+    list of jobs that raised an exception or have been abandoned.
+    """
+
+    pending = list(jobs)
+    abandoned = []
+    condition = threading.Condition()
+
+    def worker():
+        while True:
+            with condition:
+                if not pending:
+                    return
+                job = pending.pop(0)
+                job.started = time.time()
+                condition.notify()
+
+            # The default deadline is per thread and applies to all HTTP requests of the job
+            urlfetch.set_default_fetch_deadline(job.budget)
+            try:
+                job.function()
+            except Exception as e:
+                logging.exception("%s failed", job.name)
+                job.error = e
+
+            with condition:
+                job.finished = True
+                condition.notify()
+
+    def start_worker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    if not jobs:
+        return []
+
+    for _ in range(min(max_threads, len(jobs))):
+        start_worker()
+
+    with condition:
+        while True:
+            now = time.time()
+            timeout = None
+            waiting = bool(pending)
+            for job in jobs:
+                if job.finished or job.started is None or job in abandoned:
+                    continue
+                remaining = job.started + job.budget - now
+                if remaining <= 0:
+                    logging.warning("%s exceeded its budget of %s seconds", job.name, job.budget)
+                    abandoned.append(job)
+                    if pending:
+                        # The thread is still busy with the abandoned job
+                        start_worker()
+                    continue
+                waiting = True
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+
+            if not waiting:
+                return [job for job in jobs if job in abandoned or job.error is not None]
+
+            condition.wait(timeout)
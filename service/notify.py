@@ -19,24 +19,175 @@ Notification/subscription handler
 Handles subscription post requests coming from the Mirror API and forwards
 the requests to the relevant demo services.
 
+The callbacks only validate notifications and put them on the notifications
+queue (see queue.yaml), so the Mirror API gets its response right away.
+The workers run the demo services, max_concurrent_requests of the queue
+limits how many run at the same time.
+
+Demo services declare the collections, actions and contacts they handle
+in HANDLES, see demos/__init__.py. Notifications are only forwarded to matching demo services,
+and timeline notifications are dropped without fetching the item if
+there are none. Locations are always fetched to store the user's location.
+
+The matching demo services of a notification run concurrently, see dispatch.py.
+If any of them fails the task fails and is retried by the queue, only
+with the callbacks that didn't finish in an earlier attempt.
+
 """
 
 __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 
+import dispatch
 import utils
 from demos import demo_services
+from auth import execute_batch
 from auth import get_auth_service
+from auth import update_user
 
 import json
 import logging
+import webapp2
 from datetime import datetime
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
+QUEUE_NAME = "notifications"
+
+# Worker URLs are restricted to admins in app.yaml
+TIMELINE_WORKER_URL = "/notify/timeline"
+LOCATION_WORKER_URL = "/notify/locations"
+
+# Items of a bulk delete handled by one task, fetched in a single batch request
+_ITEMS_PER_TASK = 50
+
+# Seconds to remember the finished callbacks of a task for its retries
+_FINISHED_TIME = 24 * 60 * 60
+
+
+def _handles(demo_service, collection, callback):
+    """HANDLES of a demo service, None if it doesn't handle collection"""
+
+    if not hasattr(demo_service, callback):
+        return None
+    handles = getattr(demo_service, "HANDLES", {})
+    if collection not in handles.get("collections", [collection]):
+        return None
+    return handles
+
+
+def _build_timeline_index():
+    """
+    Map action types to the demo services handling timeline notifications
+
+    Demo services that don't limit their actions are listed under None.
+    Each entry is a tuple of the position in demo_services, the demo service
+    and the set of contact ids it handles (None for all contacts).
+    """
+
+    index = {}
+    for position, demo_service in enumerate(demo_services):
+        handles = _handles(demo_service, "timeline", "handle_item")
+        if handles is None:
+            continue
+        contacts = handles.get("contacts")
+        if contacts is not None:
+            contacts = frozenset(contacts)
+        for action in handles.get("actions", [None]):
+            index.setdefault(action, []).append((position, demo_service, contacts))
+    return index
+
+
+_TIMELINE_INDEX = _build_timeline_index()
+_LOCATION_DEMOS = [demo_service for demo_service in demo_services
+                   if _handles(demo_service, "locations", "handle_location") is not None]
+
+
+def _timeline_demos(data):
+    """Demo services, with their contact ids, handling a timeline notification"""
+
+    entries = set(_TIMELINE_INDEX.get(None, []))
+    for action in data.get("userActions", []):
+        entries.update(_TIMELINE_INDEX.get(action.get("type"), []))
+    return [(demo_service, contacts) for position, demo_service, contacts in sorted(entries)]
+
+
+def _job(demo_service, callback, item, data, test):
+    """Job for dispatch.run calling a callback of a demo service"""
+
+    def call():
+        # Pooled API clients are per thread, so the callback gets its own
+        service = get_auth_service(data["userToken"], test)
+        if service is None:
+            logging.info("No valid credentials")
+            return
+        getattr(demo_service, callback)(item, data, service, test)
+
+    budget = getattr(demo_service, "HANDLES", {}).get("budget", dispatch.DEFAULT_BUDGET)
+    name = "%s.%s(%s)" % (demo_service.__name__, callback, item.get("id"))
+    return dispatch.Job(name, call, budget)
+
+
+def _run_jobs(request, jobs):
+    """
+    Run the jobs of a notification task, skipping the ones that finished in an earlier attempt
+
+    Raises:
+        dispatch.DispatchError: if jobs failed, so the queue retries the task
+    """
+
+    task_name = request.headers.get("X-AppEngine-TaskName")
+    finished = set()
+    if task_name is not None:
+        finished = memcache.get(task_name, namespace="notify") or set()
+
+    jobs = [job for job in jobs if job.name not in finished]
+    failed = dispatch.run(jobs)
+    if not failed:
+        return
+
+    if task_name is not None:
+        finished.update(job.name for job in jobs if job not in failed)
+        memcache.set(task_name, finished, time=_FINISHED_TIME, namespace="notify")
+    raise dispatch.DispatchError(failed)
+
+
+def _check_notification(data, test, collection):
+    """Validate the verifyToken and collection of a notification"""
+
+    gplus_id = data["userToken"]
+    verifyToken = data["verifyToken"]
+    if not utils.check_verify_token(gplus_id, test, verifyToken):
+        # Users who connected before verify tokens were derived still have a random one
+        if test is not None:
+            user = ndb.Key("TestUser", gplus_id).get()
+        else:
+            user = ndb.Key("User", gplus_id).get()
+
+        if user is None or user.verifyToken is None or user.verifyToken != verifyToken:
+            logging.info("Wrong user")
+            return False
+
+    if data["collection"] != collection:
+        logging.info("Wrong collection")
+        return False
+
+    return True
+
+
+def _enqueue(url, message, test):
+    """Hand a validated notification over to the workers of the notifications queue"""
+
+    params = {"data": message}
+    if test is not None:
+        params["test"] = test
+    taskqueue.add(queue_name=QUEUE_NAME, url=url, params=params)
+
 
 class TimelineNotifyHandler(utils.BaseHandler):
     """
     Handles all timeline notifications (updates, deletes, inserts)
-    Forwards the information to implemented demo services
+    Validates them and queues them for TimelineNotifyWorker
     """
 
     def post(self, test):
@@ -48,38 +199,28 @@ class TimelineNotifyHandler(utils.BaseHandler):
 
         self.response.status = 200
 
-        gplus_id = data["userToken"]
-        verifyToken = data["verifyToken"]
-        if test is not None:
-            user = ndb.Key("TestUser", gplus_id).get()
-        else:
-            user = ndb.Key("User", gplus_id).get()
-        if user is None or user.verifyToken != verifyToken:
-            logging.info("Wrong user")
+        if not _check_notification(data, test, "timeline"):
             return
 
-        if data["collection"] != "timeline":
-            logging.info("Wrong collection")
+        if not _timeline_demos(data):
+            logging.info("No demo service for this notification")
             return
 
-        service = get_auth_service(gplus_id, test)
-
-        if service is None:
-            logging.info("No valid credentials")
+        # Bulk deletes send one notification with all itemIds, which is split up for the workers
+        item_ids = data.get("itemIds")
+        if item_ids is None or len(item_ids) <= _ITEMS_PER_TASK:
+            _enqueue(TIMELINE_WORKER_URL, message, test)
             return
 
-        result = service.timeline().get(id=data["itemId"]).execute()
-        logging.info(result)
-
-        for demo_service in demo_services:
-            if hasattr(demo_service, "handle_item"):
-                demo_service.handle_item(result, data, service, test)
+        for offset in range(0, len(item_ids), _ITEMS_PER_TASK):
+            data["itemIds"] = item_ids[offset:offset + _ITEMS_PER_TASK]
+            _enqueue(TIMELINE_WORKER_URL, json.dumps(data), test)
 
 
 class LocationNotifyHandler(utils.BaseHandler):
     """
     Handles all location notifications
-    Forwards the information to implemented demo services
+    Validates them and queues them for LocationNotifyWorker
     """
 
     def post(self, test):
@@ -90,25 +231,63 @@ class LocationNotifyHandler(utils.BaseHandler):
 
         self.response.status = 200
 
-        gplus_id = data["userToken"]
-        verifyToken = data["verifyToken"]
-        if test is not None:
-            user = ndb.Key("TestUser", gplus_id).get()
-        else:
-            user = ndb.Key("User", gplus_id).get()
+        if not _check_notification(data, test, "locations"):
+            return
 
-        if user is None or user.verifyToken != verifyToken:
-            logging.info("Wrong user")
+        if data["operation"] != "UPDATE":
+            logging.info("Wrong operation")
             return
 
-        if data["collection"] != "locations":
-            logging.info("Wrong collection")
+        _enqueue(LOCATION_WORKER_URL, message, test)
+
+
+class TimelineNotifyWorker(webapp2.RequestHandler):
+    """Forwards queued timeline notifications to implemented demo services"""
+
+    def post(self):
+        data = json.loads(self.request.get("data"))
+        test = self.request.get("test") or None
+
+        demos = _timeline_demos(data)
+        if not demos:
+            logging.info("No demo service for this notification")
             return
 
-        if data["operation"] != "UPDATE":
-            logging.info("Wrong operation")
+        gplus_id = data["userToken"]
+        service = get_auth_service(gplus_id, test)
+
+        if service is None:
+            logging.info("No valid credentials")
             return
 
+        # Bulk deletes send one notification with all itemIds
+        if "itemIds" in data:
+            item_ids = data["itemIds"]
+        else:
+            item_ids = [data["itemId"]]
+
+        results = execute_batch([service.timeline().get(id=item_id) for item_id in item_ids], test)
+
+        jobs = []
+        for result in results:
+            logging.info(result)
+
+            recipients = set(rec.get("id") for rec in result.get("recipients", []))
+            for demo_service, contacts in demos:
+                if contacts is None or not contacts.isdisjoint(recipients):
+                    jobs.append(_job(demo_service, "handle_item", result, data, test))
+
+        _run_jobs(self.request, jobs)
+
+
+class LocationNotifyWorker(webapp2.RequestHandler):
+    """Forwards queued location notifications to implemented demo services"""
+
+    def post(self):
+        data = json.loads(self.request.get("data"))
+        test = self.request.get("test") or None
+
+        gplus_id = data["userToken"]
         service = get_auth_service(gplus_id, test)
 
         if service is None:
@@ -119,17 +298,35 @@ class LocationNotifyHandler(utils.BaseHandler):
         logging.info(result)
 
         if "longitude" in result and "latitude" in result:
-            user.longitude = result["longitude"]
-            user.latitude = result["latitude"]
-            user.locationUpdate = datetime.utcnow()
-            user.put()
+            update_user(gplus_id, test,
+                        longitude=result["longitude"],
+                        latitude=result["latitude"],
+                        locationUpdate=datetime.utcnow())
+
+        _run_jobs(self.request, [_job(demo_service, "handle_location", result, data, test)
+                                 for demo_service in _LOCATION_DEMOS])
+
+
+class NotifyStatusHandler(webapp2.RequestHandler):
+    """Reports how many notifications are waiting for the workers"""
+
+    def get(self):
+        stats = taskqueue.QueueStatistics.fetch(taskqueue.Queue(QUEUE_NAME))
 
-        for demo_service in demo_services:
-            if hasattr(demo_service, "handle_location"):
-                demo_service.handle_location(result, data, service, test)
+        self.response.content_type = "application/json"
+        self.response.out.write(json.dumps({
+            "queue": QUEUE_NAME,
+            "tasks": stats.tasks,
+            "inFlight": stats.in_flight,
+            "executedLastMinute": stats.executed_last_minute,
+            "oldestEtaUsec": stats.oldest_eta_usec
+        }))
 
 
 NOTIFY_ROUTES = [
     (r"(/test)?/timeline_update", TimelineNotifyHandler),
-    (r"(/test)?/locations_update", LocationNotifyHandler)
+    (r"(/test)?/locations_update", LocationNotifyHandler),
+    (TIMELINE_WORKER_URL, TimelineNotifyWorker),
+    (LOCATION_WORKER_URL, LocationNotifyWorker),
+    ("/notify/status", NotifyStatusHandler)
 ]
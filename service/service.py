@@ -115,20 +115,22 @@ class AttachmentHandler(utils.BaseHandler):
             self.response.out.write(utils.createError(401, "Invalid credentials."))
             return
 
-        attachment_metadata = service.timeline().attachments().get(
-            itemId=timelineId, attachmentId=attachmentId).execute()
-        content_type = str(attachment_metadata.get("contentType"))
-        content_url = attachment_metadata.get("contentUrl")
-        resp, content = service._http.request(content_url)
-
-        if resp.status == 200:
-            self.response.content_type = content_type
-            self.response.out.write(content)
+        if test is None:
+            attachment_metadata = service.timeline().attachments().get(
+                itemId=timelineId, attachmentId=attachmentId).execute()
+            content_type = str(attachment_metadata.get("contentType"))
+            content_url = attachment_metadata.get("contentUrl")
         else:
-            logging.info(resp)
+            # The download URL of the test API is known, no need for a metadata request
+            content_type = None
+            content_url = "%s/upload/mirror/v1/timeline/%s/attachments/%s" % (utils.base_url, timelineId, attachmentId)
+
+        status = utils.proxy_attachment(service._http, content_url, self.request, self.response, content_type)
+        if status not in (200, 206, 304):
+            logging.info("Attachment download failed with status %s" % status)
             self.response.content_type = "application/json"
-            self.response.status = resp.status
-            self.response.out.write(utils.createError(resp.status, "Unable to retrieve attachment."))
+            self.response.status = status
+            self.response.out.write(utils.createError(status, "Unable to retrieve attachment."))
 
 
 SERVICE_ROUTES = [
@@ -19,6 +19,7 @@ __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 
 from utils import base_url
 
+import base64
 import io
 import json
 import logging
@@ -28,19 +29,77 @@ from apiclient.http import MediaIoBaseUpload
 
 _BOUNDARY = "-----1234567890abc"
 
+# In test mode content larger than this is sent in chunks using a resumable upload
+_RESUMABLE_THRESHOLD = 1024 * 1024
+
+# Has to be a multiple of 256KB, the block size of cloud storage
+_CHUNK_SIZE = 1024 * 1024
+
+# Number of chunks in a row that may be sent without the upload advancing
+_MAX_RESUME_RETRIES = 3
+
+# Has to be a multiple of 3, so that encoded chunks can be concatenated
+_BASE64_CHUNK_SIZE = 3 * 64 * 1024
+
+
+def _encode_base64(content):
+    """Base64 encode content in chunks, without line breaks"""
+
+    for start in xrange(0, len(content), _BASE64_CHUNK_SIZE):
+        yield base64.b64encode(content[start:start + _BASE64_CHUNK_SIZE])
+
 
 def _create_multipart_body(metadata, content, contentType):
-    base64_data = content.encode("base64").replace("\n", "")
-    multipart_body = "\r\n--" + _BOUNDARY + "\r\n"
-    multipart_body += "Content-Type: application/json\r\n\r\n"
-    multipart_body += json.dumps(metadata)
-    multipart_body += "\r\n--" + _BOUNDARY + "\r\n"
-    multipart_body += "Content-Type: " + contentType + "\r\n"
-    multipart_body += "Content-Transfer-Encoding: base64\r\n\r\n"
-    multipart_body += base64_data
-    multipart_body += "\r\n\r\n--" + _BOUNDARY + "--"
+    # Collect all pieces first, so the body is only copied once when joining them
+    multipart_body = ["\r\n--" + _BOUNDARY + "\r\n"]
+    multipart_body.append("Content-Type: application/json\r\n\r\n")
+    multipart_body.append(json.dumps(metadata))
+    multipart_body.append("\r\n--" + _BOUNDARY + "\r\n")
+    multipart_body.append("Content-Type: " + contentType + "\r\n")
+    multipart_body.append("Content-Transfer-Encoding: base64\r\n\r\n")
+    multipart_body.extend(_encode_base64(content))
+    multipart_body.append("\r\n\r\n--" + _BOUNDARY + "--")
 
-    return multipart_body
+    return "".join(multipart_body)
+
+
+def _resumable_upload(url, method, metadata, content, contentType, service):
+    """Upload content in chunks using the resumable upload protocol of the test environment"""
+
+    headers = {}
+    headers["Content-Type"] = "application/json; charset=UTF-8"
+    headers["X-Upload-Content-Type"] = contentType
+    headers["X-Upload-Content-Length"] = str(len(content))
+
+    resp, body = service._http.request(url + "?uploadType=resumable", method=method, body=json.dumps(metadata), headers=headers)
+    if resp.status != 200:
+        return resp, body
+
+    session_url = resp["location"]
+    offset = 0
+    retries = 0
+    while True:
+        chunk = content[offset:offset + _CHUNK_SIZE]
+        headers = {"Content-Range": "bytes %s-%s/%s" % (offset, offset + len(chunk) - 1, len(content))}
+        resp, body = service._http.request(session_url, method="PUT", body=chunk, headers=headers)
+        if resp.status != 308:
+            return resp, body
+
+        # Continue after the last byte that has been received
+        received = 0
+        if "range" in resp:
+            received = int(resp["range"].split("-")[1]) + 1
+
+        # Give up if the server keeps not taking the chunks
+        if received <= offset:
+            retries += 1
+            if retries > _MAX_RESUME_RETRIES:
+                logging.error("Resumable upload to %s makes no progress" % session_url)
+                return resp, body
+        else:
+            retries = 0
+
+        offset = received
 
 
 def multipart_insert(metadata, content, contentType, service, test):
@@ -58,6 +117,9 @@ def multipart_insert(metadata, content, contentType, service, test):
             logging.error("Multipart update error: %s" % error)
             return error
 
+    if len(content) > _RESUMABLE_THRESHOLD:
+        return _resumable_upload(base_url + "/upload/mirror/v1/timeline", "POST", metadata, content, contentType, service)
+
     # Constructing the multipart upload for test environement
     multipart_body = _create_multipart_body(metadata, content, contentType)
 
@@ -82,13 +144,16 @@ def multipart_update(cardId, metadata, content, contentType, service, test):
             logging.error("Multipart update error: %s" % error)
             return error
 
+    if len(content) > _RESUMABLE_THRESHOLD:
+        return _resumable_upload("%s/upload/mirror/v1/timeline/%s" % (base_url, cardId), "PUT", metadata, content, contentType, service)
+
     # Constructing the multipart upload for test environement
     multipart_body = _create_multipart_body(metadata, content, contentType)
 
     headers = {}
     headers["Content-Type"] = "multipart/related; boundary=\"" + _BOUNDARY + "\""
 
-    return service._http.request("%s/upload/mirror/v1/timeline/%s" % (base_url, cardId), method="POST", body=multipart_body, headers=headers)
+    return service._http.request("%s/upload/mirror/v1/timeline/%s" % (base_url, cardId), method="PUT", body=multipart_body, headers=headers)
 
 
 def media_insert(cardId, content, contentType, service, test):
@@ -103,6 +168,9 @@ def media_insert(cardId, content, contentType, service, test):
             logging.error("Attachment insert error: %s" % error)
             return error
 
+    if len(content) > _RESUMABLE_THRESHOLD:
+        return _resumable_upload("%s/upload/mirror/v1/timeline/%s/attachments" % (base_url, cardId), "POST", {}, content, contentType, service)
+
     # Constructing the multipart upload for test environement
     multipart_body = _create_multipart_body({}, content, contentType)
 
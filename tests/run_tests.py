@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Run the tests in this directory with the App Engine SDK
+
+    python tests/run_tests.py /path/to/google_appengine
+
+The SDK path can also be set in the APPENGINE_SDK environment variable.
+The SDK puts its bundled libraries (webapp2, jinja2, ...) on the path,
+lib/ and the repository root are added by the tests themselves. Local
+id_token verification needs PyCrypto or pyOpenSSL installed as well.
+"""
+
+__author__ = 'scarygami@gmail.com (Gerwin Sturm)'
+
+import os
+import sys
+import unittest
+
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    suite = unittest.TestLoader().discover(_TESTS_DIR)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sdk_path = sys.argv[1]
+    else:
+        sdk_path = os.environ.get("APPENGINE_SDK")
+    if not sdk_path:
+        sys.stderr.write(__doc__)
+        sys.exit(2)
+
+    sys.exit(main(sdk_path))
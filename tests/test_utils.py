@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the local verification of id_tokens in utils.py
+
+Run with tests/run_tests.py, which sets up the App Engine SDK:
+
+    python tests/run_tests.py /path/to/google_appengine
+
+CERT is an X.509 v3 certificate in the same format as the ones served at
+ID_TOKEN_VERIFICATON_CERTS, ID_TOKEN was signed with its private key.
+Google's own keys can't sign test tokens, and they rotate every few days.
+"""
+
+__author__ = 'scarygami@gmail.com (Gerwin Sturm)'
+
+import os
+import sys
+import unittest
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(_ROOT_DIR)
+sys.path.insert(0, _ROOT_DIR)
+sys.path.insert(0, os.path.join(_ROOT_DIR, "lib"))
+
+import httplib2
+import utils
+
+CERT = (
+    "-----BEGIN CERTIFICATE-----\n"
+    "MIIDRTCCAi2gAwIBAgIURKQ3X1//tZlOv6K9synN9toS9ecwDQYJKoZIhvcNAQEL\n"
+    "BQAwMTEvMC0GA1UEAwwmc2VjdXJldG9rZW4uc3lzdGVtLmdzZXJ2aWNlYWNjb3Vu\n"
+    "dC5jb20wIBcNMjYxMDE5MTMxNzA2WhgPMjEyNjA5MjUxMzE3MDZaMDExLzAtBgNV\n"
+    "BAMMJnNlY3VyZXRva2VuLnN5c3RlbS5nc2VydmljZWFjY291bnQuY29tMIIBIjAN\n"
+    "BgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA0t1ih/2neRFpWEZjuGQndCtgB1oI\n"
+    "/5esLVX78na9W3XFyk78DAjOMAE8/aFof87kSmmb6wcc3xEZW5wREk5KgiIiIHC/\n"
+    "udHzPcPFgg++XLMaPMzDEQsYxg1rXLdLR94sfP/Q1o1TN+fiCVgyTlu3zFUbfOi3\n"
+    "M9sxnPnQqEdefZ7BasvC1jIY/k+XaSaj9V9LpV8EbnRsddIn9U8Ft9yGeiVVilyb\n"
+    "zXcX+iNm1W6Odm6U4uyFsc8rTgbxteFMjMD0E/Oeub0lrM7AtMAAGM7uQqEc7RMH\n"
+    "5ph9k0wPf0j8VxptYsPA14MJbdocYMGzISqpHfeTMKZl6MMgLvEu4otFHQIDAQAB\n"
+    "o1MwUTAdBgNVHQ4EFgQUJnTJWPN+I3rJ1afDlVfQMqQzmVkwHwYDVR0jBBgwFoAU\n"
+    "JnTJWPN+I3rJ1afDlVfQMqQzmVkwDwYDVR0TAQH/BAUwAwEB/zANBgkqhkiG9w0B\n"
+    "AQsFAAOCAQEAsSNMh5Gi1xuTuJBO7eAx4JXu7KFLT+mW9MxS8Sfqij7CIbuZnP2a\n"
+    "wGL2Z8tNHutF/K4m511cJs1ubkee5pTN0MLFG/DWvCm4xIKkVv9cSIZ4eG+saQxm\n"
+    "fHGy+sMdV6v/1Hu4jww4+BQpl/vi6EFR1zImfWxqbLBLmLYC7X5ceeG7h9D3CVXG\n"
+    "GLPf1vbYDhmMXEe1Q+UojTUJkmFpH4Yer7ZuMR/h5f0qqb56bp9A3rFKFK5ZQv0m\n"
+    "PecGqKF1XCF8hJtCR3x0U+z6lVjSGRKz/xtHVfsp7IwRYmucZKptUWNQE9liVXT+\n"
+    "1OBq9WOpi7wXE7mmR/yIc6+HgV2B2ePE+Q==\n"
+    "-----END CERTIFICATE-----\n"
+)
+
+ID_TOKEN = (
+    "eyJhbGciOiJSUzI1NiIsImtpZCI6InRlc3QifQ."
+    "eyJhdWQiOiJDTElFTlRfSUQiLCJhenAiOiJDTElFTlRfSUQiLCJlbWFpbCI6InVzZXJAZXhhbXBsZS5jb20iLCJleHAiOjQxMDI0NDQ4MDAsImlhdCI6MTQwMDAwMDAwMCwiaXNzIjoiYWNjb3VudHMuZ29vZ2xlLmNvbSIsInN1YiI6IjEyMzQ1Njc4OTAifQ."
+    "SOeDs5YsX8koddO273dFeEb6lQmxWwr-YycSVb-maB8M-WWoZq9Ich4qUrQZRspzAmw43AVohuDgRBhJzsCYQkMYr7i01cL2qzv-zuBDhKqKHaF38Ipcu-QSFJ__BsjozSPo3WSd8_tmx2cg-9xrbSR6q0rjosTEibUOeOPAGHwNBCZ9Lqf3y9vC1WfQxNFf1l-7Yvm6yapdHN9bGj5vx9gYtU_VaVmbCDScnfXvzCFUQkAo2LEyO7yQyjNL4ohWKzFyi04xid3rRQEWPcYRlx0KCKx3e1_U0EVloiC7KkkjD46sfOCj7MGShHteeZ7q5Tz8-U3yuuKQ1I3XtHbu4w"
+)
+
+# Claims of ID_TOKEN, it expires in 2100
+CLIENT_ID = "CLIENT_ID"
+USER_ID = "1234567890"
+
+
+class VerifyIdTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self._get_id_token_certs = utils._get_id_token_certs
+        self._client_id = utils.CLIENT_ID
+        utils._get_id_token_certs = lambda: {"test": CERT}
+        utils.CLIENT_ID = CLIENT_ID
+        utils._id_token_verifiers.clear()
+
+    def tearDown(self):
+        utils._get_id_token_certs = self._get_id_token_certs
+        utils.CLIENT_ID = self._client_id
+        utils._id_token_verifiers.clear()
+
+    def test_verifier_reads_certificate(self):
+        header, payload, signature = ID_TOKEN.split(".")
+        verifier = utils._get_verifier(CERT)
+        self.assertTrue(verifier.verify("%s.%s" % (header, payload), utils._urlsafe_b64decode(signature)))
+        self.assertFalse(verifier.verify("%s.%s" % (header, payload[:-2]), utils._urlsafe_b64decode(signature)))
+
+    def test_valid_token(self):
+        claims = utils.verify_id_token(ID_TOKEN)
+        self.assertIsNotNone(claims)
+        self.assertEqual(claims["sub"], USER_ID)
+        self.assertEqual(claims["aud"], CLIENT_ID)
+
+    def test_tampered_token(self):
+        header, payload, signature = ID_TOKEN.split(".")
+        self.assertIsNone(utils.verify_id_token("%s.%s.%s" % (header, payload, signature[:-4] + "AAAA")))
+
+    def test_other_client(self):
+        utils.CLIENT_ID = "other"
+        self.assertIsNone(utils.verify_id_token(ID_TOKEN))
+
+    def test_malformed_token(self):
+        self.assertIsNone(utils.verify_id_token("not.a-token"))
+
+    def test_certificate_fetch_fails(self):
+        def fail():
+            raise httplib2.HttpLib2Error("Deadline exceeded")
+        utils._get_id_token_certs = fail
+        self.assertIsNone(utils.verify_id_token(ID_TOKEN))
+
+    def test_invalid_certificate(self):
+        utils._get_id_token_certs = lambda: {"test": "-----BEGIN CERTIFICATE-----\nAAAA\n-----END CERTIFICATE-----\n"}
+        self.assertIsNone(utils.verify_id_token(ID_TOKEN))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,15 +17,30 @@
 
 __author__ = 'scarygami@gmail.com (Gerwin Sturm)'
 
+import base64
+import hashlib
+import hmac
+import httplib2
 import jinja2
 import json
+import logging
 import os
+import re
+import time
+import uritemplate
 import webapp2
 
-from apiclient.discovery import build
+from apiclient.discovery import DISCOVERY_URI
+from apiclient.discovery import build_from_document
+from apiclient.errors import HttpError
+from apiclient.errors import UnknownApiNameOrVersion
+from google.appengine.api import memcache
 from google.appengine.api.app_identity import get_application_id
 from google.appengine.ext import ndb
+from oauth2client import crypt
 from oauth2client.appengine import CredentialsNDBProperty
+from oauth2client.client import ID_TOKEN_VERIFICATON_CERTS
+from oauth2client.client import flow_from_clientsecrets
 from webapp2_extras import sessions
 from webapp2_extras.appengine import sessions_memcache
 
@@ -41,10 +56,19 @@ with open("client_secrets.json", "r") as fh:
     CLIENT_ID = secrets["client_id"]
     SESSION_KEY = str(secrets["session_secret"])
     API_KEY = secrets["api_key"]
+    ADDITIONAL_CLIENT_IDS = secrets.get("additional_client_ids", [])
+    # Newest first, tokens made with any of them are accepted so secrets can be rotated
+    VERIFY_SECRETS = [str(secret) for secret in secrets.get("verify_secrets", [])] or [SESSION_KEY]
 
 config = {}
 config["webapp2_extras.sessions"] = {"secret_key": SESSION_KEY}
 
+# Discovery document snapshots, see utils/refresh_discovery.py
+_DISCOVERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "discovery")
+
+# Parsed discovery documents by (api, version, url_template), shared by all threads
+_discovery_documents = {}
+
 # Add any additional scopes that you might need for your service to access other Google APIs
 COMMON_SCOPES = ["https://www.googleapis.com/auth/plus.login"]
 
@@ -63,6 +87,23 @@ REQUEST_VISIBLE_ACTIONS = [
 ]
 
 
+# Request headers passed on when proxying attachment downloads
+_PROXY_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+
+# Response headers passed back to the browser, so it can cache attachments
+_PROXY_RESPONSE_HEADERS = ("Accept-Ranges", "Cache-Control", "Content-Range", "ETag", "Last-Modified")
+
+_TOKENINFO_URL = "https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s"
+
+_ID_TOKEN_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+# Used for the certificates if the response doesn't specify a max-age
+_CERTS_DEFAULT_MAX_AGE = 60 * 60
+
+# Verifiers by certificate, shared by all threads
+_id_token_verifiers = {}
+
+
 def createError(code, message):
     """Create a JSON string to be returned as error response to requests"""
     return json.dumps({"error": {"code": code, "message": message}})
@@ -73,6 +114,201 @@ def createMessage(message):
     return json.dumps({"message": message})
 
 
+def _verify_token_hmac(secret, gplus_id, test):
+    message = "%s:%s" % ("test" if test is not None else "real", gplus_id)
+    return hmac.new(secret, message.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def create_verify_token(gplus_id, test):
+    """Create the verifyToken for the subscriptions of a user from the current secret"""
+
+    return _verify_token_hmac(VERIFY_SECRETS[0], gplus_id, test)
+
+
+def check_verify_token(gplus_id, test, token):
+    """Check a verifyToken against all current and previous secrets without any datastore access"""
+
+    if not isinstance(token, basestring):
+        return False
+    token = str(token)
+
+    valid = False
+    for secret in VERIFY_SECRETS:
+        expected = _verify_token_hmac(secret, gplus_id, test)
+        # Compare in constant time so the token can't be guessed byte by byte
+        if len(expected) == len(token):
+            result = 0
+            for x, y in zip(expected, token):
+                result |= ord(x) ^ ord(y)
+            valid = valid or result == 0
+
+    return valid
+
+
+class _ExchangeHttp(httplib2.Http):
+    """Keeps the response of the code exchange, oauth2client only keeps the unverified id_token payload"""
+
+    content = None
+
+    def request(self, *args, **kwargs):
+        response, self.content = httplib2.Http.request(self, *args, **kwargs)
+        return response, self.content
+
+
+def _urlsafe_b64decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def _get_id_token_certs():
+    """Google's current id_token certificates, cached in memcache as long as Google allows"""
+
+    certs = memcache.get("certs", namespace="id_token")
+    if certs is not None:
+        return certs
+
+    response, content = httplib2.Http().request(ID_TOKEN_VERIFICATON_CERTS)
+    if response.status != 200:
+        logging.warning("Failed to fetch id_token certificates: %s", response.status)
+        return None
+    certs = json.loads(content)
+
+    match = re.search(r"max-age=(\d+)", response.get("cache-control", ""))
+    max_age = int(match.group(1)) if match else _CERTS_DEFAULT_MAX_AGE
+    memcache.set("certs", certs, time=max_age, namespace="id_token")
+
+    return certs
+
+
+def _get_verifier(cert):
+    """crypt.Verifier for a PEM certificate"""
+
+    verifier = _id_token_verifiers.get(cert)
+    if verifier is not None:
+        return verifier
+
+    if crypt.Verifier is crypt.PyCryptoVerifier:
+        # PyCrypto can't read certificates, so the public key is taken out of it
+        from Crypto.PublicKey import RSA
+        from Crypto.Util.asn1 import DerSequence
+        lines = cert.strip().split("\n")
+        certificate = DerSequence()
+        certificate.decode(base64.b64decode("".join(lines[1:-1])))
+        tbs_certificate = DerSequence()
+        tbs_certificate.decode(certificate[0])
+        verifier = crypt.PyCryptoVerifier(RSA.importKey(tbs_certificate[6]))
+    else:
+        verifier = crypt.Verifier.from_string(cert, True)
+
+    _id_token_verifiers[cert] = verifier
+    return verifier
+
+
+def verify_id_token(id_token):
+    """Verify a signed id_token issued to this app, returns its claims or None
+
+    The signature is checked locally against Google's cached certificates.
+    Any failure, including fetching the certificates, returns None, so
+    callers fall back to the tokeninfo endpoint.
+    """
+
+    try:
+        return _verify_id_token(id_token)
+    except Exception:
+        logging.exception("Failed to verify id_token")
+        return None
+
+
+def _verify_id_token(id_token):
+    certs = _get_id_token_certs()
+    if certs is None:
+        return None
+
+    try:
+        header, payload, signature = [str(segment) for segment in id_token.split(".")]
+        claims = json.loads(_urlsafe_b64decode(payload))
+        signature = _urlsafe_b64decode(signature)
+    except (ValueError, TypeError):
+        logging.warning("Malformed id_token")
+        return None
+
+    signed = "%s.%s" % (header, payload)
+    if not any(_get_verifier(cert).verify(signed, signature) for cert in certs.values()):
+        logging.warning("Invalid id_token signature")
+        return None
+
+    now = time.time()
+    if (claims.get("iss") not in _ID_TOKEN_ISSUERS or
+            claims.get("aud") != CLIENT_ID or
+            claims.get("iat", now) - crypt.CLOCK_SKEW_SECS > now or
+            claims.get("exp", 0) + crypt.CLOCK_SKEW_SECS < now):
+        logging.warning("Invalid id_token claims")
+        return None
+
+    return claims
+
+
+def exchange_code(code):
+    """Exchange a one-time authorization code, returns the credentials and their token info
+
+    The token info has the fields of the tokeninfo endpoint. It is taken from the
+    id_token of the exchange, verified locally, and only requested from tokeninfo
+    if that isn't possible. Raises FlowExchangeError if the exchange fails.
+    """
+
+    oauth_flow = flow_from_clientsecrets("client_secrets.json", scope="")
+    oauth_flow.redirect_uri = "postmessage"
+    http = _ExchangeHttp()
+    credentials = oauth_flow.step2_exchange(code, http=http)
+
+    try:
+        id_token = json.loads(http.content).get("id_token")
+    except ValueError:
+        id_token = None
+
+    claims = verify_id_token(id_token) if id_token is not None else None
+    if claims is not None:
+        # Older id_tokens have the user ID in id instead of sub
+        result = {"user_id": claims.get("sub", claims.get("id")), "issued_to": claims.get("azp", claims["aud"])}
+        if "email" in claims:
+            result["email"] = claims["email"]
+        return credentials, result
+
+    # Fall back to the tokeninfo endpoint
+    url = _TOKENINFO_URL % credentials.access_token
+    result = json.loads(httplib2.Http().request(url, "GET")[1])
+    return credentials, result
+
+
+def proxy_attachment(http, url, request, response, content_type=None):
+    """Download an attachment with an authorized http object and write it to response
+
+    Range and conditional request headers are passed through in both directions,
+    so browsers can seek in videos and revalidate cached attachments.
+
+    Returns the HTTP status of the download, nothing is written for errors.
+    """
+
+    headers = {}
+    for header in _PROXY_REQUEST_HEADERS:
+        if header in request.headers:
+            headers[header] = request.headers[header]
+
+    resp, content = http.request(url, headers=headers)
+    if resp.status not in (200, 206, 304):
+        return resp.status
+
+    response.status = resp.status
+    for header in _PROXY_RESPONSE_HEADERS:
+        if header.lower() in resp:
+            response.headers[header] = resp[header.lower()]
+
+    if resp.status != 304:
+        response.content_type = content_type or resp["content-type"]
+        response.out.write(content)
+
+    return resp.status
+
+
 class BaseHandler(webapp2.RequestHandler):
     """Base request handler to enable session storage for all handlers"""
 
@@ -92,11 +328,109 @@ class BaseHandler(webapp2.RequestHandler):
         return self.session_store.get_session(name='mirror_session', factory=sessions_memcache.MemcacheSessionFactory)
 
 
+def _snapshot_name(api, version, internal):
+    return ("internal/" if internal else "") + "%s.%s.json" % (api, version)
+
+
+def _load_discovery_manifest():
+    """Snapshots listed by utils/refresh_discovery.py with their revisions, empty if there are none
+
+    Snapshots are optional, without them the documents are fetched once per instance.
+    Only snapshots that the manifest lists but that are missing are logged.
+    """
+
+    path = os.path.join(_DISCOVERY_DIR, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as fh:
+        manifest = json.load(fh)
+
+    for name in manifest:
+        if not os.path.exists(os.path.join(_DISCOVERY_DIR, name)):
+            logging.error("Discovery snapshot %s listed in the manifest is missing", name)
+
+    return manifest
+
+
+_discovery_manifest = _load_discovery_manifest()
+
+
+def _load_discovery_snapshot(api, version, internal):
+    """Load a discovery document shipped with the app, None if there is no snapshot
+
+    Snapshots are created with utils/refresh_discovery.py. The one for the
+    internal Mirror API can come from any deployment, so its requests are
+    pointed at this app.
+    """
+
+    name = _snapshot_name(api, version, internal)
+    path = os.path.join(_DISCOVERY_DIR, name)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as fh:
+        document = json.load(fh)
+
+    revision = document.get("revision")
+    expected = _discovery_manifest.get(name, {}).get("revision")
+    if expected is not None and revision != expected:
+        logging.error("Discovery snapshot %s has revision %s, the manifest expects %s", name, revision, expected)
+
+    if internal:
+        document["rootUrl"] = discovery_url + "/"
+
+    return document
+
+
+def get_discovery_document(api, version, url_template=None):
+    """Load the discovery document for an API once per process
+
+    Snapshots shipped with the app are used if available, otherwise the
+    document is fetched from url_template, Google's discovery service by default.
+    Fetching is the expected path for deployments without snapshots.
+
+    Raises:
+        UnknownApiNameOrVersion: if there is no discovery document for api and version
+        HttpError: if the discovery document can't be fetched
+    """
+
+    if url_template is None:
+        url_template = DISCOVERY_URI
+
+    key = (api, version, url_template)
+    document = _discovery_documents.get(key)
+    if document is not None:
+        return document
+
+    internal = url_template == discovery_service_url
+    document = _load_discovery_snapshot(api, version, internal)
+    if document is None:
+        url = uritemplate.expand(url_template, {"api": api, "apiVersion": version})
+        logging.info("No discovery snapshot %s, fetching %s", _snapshot_name(api, version, internal), url)
+        resp, content = httplib2.Http().request(url)
+        if resp.status == 404:
+            raise UnknownApiNameOrVersion("name: %s  version: %s" % (api, version))
+        if resp.status >= 400:
+            raise HttpError(resp, content, uri=url)
+        document = json.loads(content)
+
+    _discovery_documents[key] = document
+
+    return document
+
+
+def build_service(api, version, http, url_template=None):
+    """Build a Google API service from the cached discovery document"""
+
+    return build_from_document(get_discovery_document(api, version, url_template), http=http)
+
+
 def build_service_from_service(service, api, version):
     """Build a Google API service using another pre-authed service"""
-    
-    new_service = build(api, version, http=service._http)
-    
+
+    new_service = build_service(api, version, service._http)
+
     return new_service
 
 
@@ -106,12 +440,14 @@ class User(ndb.Model):
     Properties:
         displayName     Name of the user as returned by the Google+ API
         imageUrl        Avatar image of the user as returned by the Google+ API
-        verifyToken     Random token generated for each user to check validity of incoming notifications
+        verifyToken     Random token of users who connected before verify tokens were derived with
+                        create_verify_token, still accepted for their notifications
         credentials     OAuth2 Access and refresh token to be used for requests against the Mirror API
         latitude        Latest recorded latitude of the user
         longitude       Latest recorded longitude of the user
         locationUpdate  DateTime at which the location of the user was last update
         friends         List of Google+ friends id, as returned by the Google+ API
+        tokenExpiry     Expiry of the access token in credentials, to refresh it in time
     """
 
     displayName = ndb.StringProperty()
@@ -122,6 +458,8 @@ class User(ndb.Model):
     longitude = ndb.FloatProperty()
     locationUpdate = ndb.DateTimeProperty()
     friends = ndb.StringProperty(repeated=True)
+    tokenExpiry = ndb.ComputedProperty(
+        lambda self: self.credentials.token_expiry if self.credentials is not None else None)
 
 
 class TestUser(User):
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# Copyright (C) 2013 Gerwin Sturm, FoldedSoft e.U.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Download snapshots of the discovery documents used by the app
+
+The app builds its API clients from these files instead of fetching the
+discovery documents at runtime. Run this from the root of the repository
+whenever one of the APIs changes, and deploy the updated files:
+
+    python utils/refresh_discovery.py [yourapp]
+
+The internal Mirror API is fetched from yourapp.appspot.com, which needs
+to be deployed already. The application name defaults to the one in app.yaml.
+
+discovery/manifest.json records the revision of every snapshot, so the app
+can tell when a snapshot doesn't match the manifest it was deployed with.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+import urllib2
+
+# APIs used from Google's discovery service
+GOOGLE_APIS = [("mirror", "v1"), ("plus", "v1")]
+
+# APIs implemented by this app with Cloud Endpoints
+INTERNAL_APIS = [("mirror", "v1")]
+
+_GOOGLE_URL = "https://www.googleapis.com/discovery/v1/apis/%s/%s/rest"
+_INTERNAL_URL = "https://%s.appspot.com/_ah/api/discovery/v1/apis/%s/%s/rest"
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_DISCOVERY_DIR = os.path.join(_ROOT_DIR, "discovery")
+
+
+def _app_name():
+    with open(os.path.join(_ROOT_DIR, "app.yaml"), "r") as fh:
+        match = re.search(r"^application:\s*(\S+)", fh.read(), re.MULTILINE)
+    return match.group(1)
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(path, "w") as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+
+def _save(url, name, manifest):
+    print "Fetching %s" % url
+    document = json.load(urllib2.urlopen(url))
+
+    _write_json(os.path.join(_DISCOVERY_DIR, name), document)
+
+    manifest[name] = {
+        "url": url,
+        "revision": document.get("revision"),
+        "etag": document.get("etag"),
+        "fetched": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    }
+
+
+def main(argv):
+    app_name = argv[1] if len(argv) > 1 else _app_name()
+
+    manifest = {}
+
+    for api, version in GOOGLE_APIS:
+        _save(_GOOGLE_URL % (api, version), "%s.%s.json" % (api, version), manifest)
+
+    for api, version in INTERNAL_APIS:
+        _save(_INTERNAL_URL % (app_name, api, version), "internal/%s.%s.json" % (api, version), manifest)
+
+    _write_json(os.path.join(_DISCOVERY_DIR, "manifest.json"), manifest)
+
+
+if __name__ == "__main__":
+    main(sys.argv)